@@ -0,0 +1,466 @@
+import re
+import json
+import time
+import random
+import threading
+import itertools
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# File content is this block repeated, so files of any size are served without holding them in memory
+CONTENT_BLOCK = bytes(range(256)) * 4096
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class Faults:
+    """ Faults injected by the stand-in server. latency is added to every request, bandwidth caps
+    each download and upload body in bytes/s, throttle_rate is the share of requests answered with
+    429 and Retry-After: retry_after, disconnect_rate the share of downloads cut off half way """
+    def __init__(self, latency=0.0, bandwidth=None, throttle_rate=0.0, retry_after=0.1, disconnect_rate=0.0,
+                 seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+
+class Library:
+    """ In-memory document library: a drive of folders and files whose content is generated """
+    def __init__(self, name, drive_id):
+        self.name = name
+        self.drive_id = drive_id
+        self.ids = itertools.count(1)
+        self.items = {}
+        self.root = self.add_item(None, "root", folder=True)
+
+    def add_item(self, parent, name, size=0, folder=False):
+        item_id = "{}-{}".format(self.drive_id, next(self.ids))
+        item = {"id": item_id, "name": name, "size": size, "parent": parent, "children": [] if folder else None,
+                "version": 1}
+        self.items[item_id] = item
+        if parent is not None:
+            self.items[parent]["children"].append(item_id)
+        return item
+
+    def find_child(self, parent, name):
+        for child_id in self.items[parent]["children"]:
+            if self.items[child_id]["name"] == name:
+                return self.items[child_id]
+        return None
+
+    def path(self, item):
+        names = []
+        while item["parent"] is not None:
+            item = self.items[item["parent"]]
+            names.append(item["name"])
+        return "".join("/" + name for name in reversed(names[:-1]))
+
+
+class FakeGraph:
+    """ State of the stand-in server: sites with document libraries and lists, and request counters """
+    def __init__(self, site_name="bench", hostname="bench.sharepoint.com", faults=None):
+        self.site_name = site_name
+        self.hostname = hostname
+        self.site_id = "{},site-1,web-1".format(hostname)
+        self.faults = faults or Faults()
+        self.libraries = {}
+        self.lists = {}
+        self.upload_sessions = {}
+        self.session_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.throttled = 0
+        self.disconnected = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.origin = None
+
+    def add_library(self, name):
+        library = Library(name, "drive-{}".format(len(self.libraries) + 1))
+        self.libraries[library.drive_id] = library
+        return library
+
+    def add_small_files(self, library, count, size):
+        for number in range(count):
+            library.add_item(library.root["id"], "small_{:06d}.bin".format(number), size)
+
+    def add_huge_files(self, library, count, size):
+        for number in range(count):
+            library.add_item(library.root["id"], "huge_{:03d}.bin".format(number), size)
+
+    def add_folder_tree(self, library, depth, fanout, files_per_folder, size, parent=None, level=0):
+        parent = parent or library.root["id"]
+        for number in range(files_per_folder):
+            library.add_item(parent, "file_{:03d}.bin".format(number), size)
+        if level < depth:
+            for number in range(fanout):
+                folder = library.add_item(parent, "folder_{}_{}".format(level, number), folder=True)
+                self.add_folder_tree(library, depth, fanout, files_per_folder, size, folder["id"], level + 1)
+
+    def add_list(self, name, count, columns=10):
+        self.lists["list-{}".format(len(self.lists) + 1)] = {
+            "name": name,
+            "items": [{"id": str(number),
+                       "fields": dict({"Title": "Item {}".format(number), "Status": "Open" if number % 2 else "Closed"},
+                                      **{"Column{}".format(column): "value {} {}".format(number, column)
+                                         for column in range(columns)})}
+                      for number in range(count)]}
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = Counter()
+            self.throttled = self.disconnected = self.bytes_sent = self.bytes_received = 0
+
+    def counters(self):
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "by_endpoint": dict(self.requests),
+                    "throttled": self.throttled, "disconnected": self.disconnected,
+                    "bytes_sent": self.bytes_sent, "bytes_received": self.bytes_received}
+
+    def drive_item(self, library, item):
+        value = {"id": item["id"], "name": item["name"], "size": item["size"],
+                 "eTag": '"{{{}}},{}"'.format(item["id"], item["version"]),
+                 "cTag": '"c:{{{}}},{}"'.format(item["id"], item["version"]),
+                 "lastModifiedDateTime": "2024-01-01T00:00:00Z",
+                 "webUrl": "https://{}/sites/{}/{}/{}".format(self.hostname, self.site_name, library.name, item["name"]),
+                 "parentReference": {"driveId": library.drive_id, "id": item["parent"],
+                                     "path": "/drives/{}/root:{}".format(library.drive_id, library.path(item))}}
+        if item["children"] is None:
+            value["file"] = {"mimeType": "application/octet-stream"}
+            value["@microsoft.graph.downloadUrl"] = "{}/download/{}/{}".format(
+                self.origin, library.drive_id, item["id"])
+        else:
+            value["folder"] = {"childCount": len(item["children"])}
+        return value
+
+
+def page(values, query, url):
+    """ Slice values into an @odata.nextLink page the way Graph does, driven by $top and $skiptoken """
+    top = min(int(query.get("$top", [DEFAULT_PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+    skip = int(query.get("$skiptoken", [0])[0])
+    body = {"value": values[skip:skip + top]}
+    if skip + top < len(values):
+        body["@odata.nextLink"] = re.sub(r"([?&])\$skiptoken=\d+", "", url) + \
+            ("&" if "?" in url else "?") + "$skiptoken={}".format(skip + top)
+    return body
+
+
+class GraphHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, Nagle's algorithm would delay every small response
+    disable_nagle_algorithm = True
+    graph = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                data += self.throttled_read(size)
+                self.rfile.readline()
+            return bytes(data)
+        return self.throttled_read(int(self.headers.get("Content-Length") or 0))
+
+    def throttled_read(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.rfile.read(min(WRITE_CHUNK_SIZE, length - len(data)))
+            if not chunk:
+                break
+            data += chunk
+            self.pace(len(chunk))
+        with self.graph.lock:
+            self.graph.bytes_received += len(data)
+        return bytes(data)
+
+    def pace(self, length):
+        if self.graph.faults.bandwidth:
+            time.sleep(length / self.graph.faults.bandwidth)
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, code, headers=None):
+        self.send_json({"error": {"code": code, "message": code}}, status, headers)
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = parse_qs(url.query)
+        endpoint, handler, args = self.route(method, path)
+        self.graph.count(endpoint)
+        faults = self.graph.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        if handler is None:
+            self.read_body()
+            return self.send_error_json(404, "itemNotFound")
+        if endpoint != "token" and faults.draw(faults.throttle_rate):
+            with self.graph.lock:
+                self.graph.throttled += 1
+            self.read_body()
+            return self.send_error_json(429, "tooManyRequests", {"Retry-After": str(faults.retry_after)})
+        handler(query, *args)
+
+    def route(self, method, path):
+        routes = [
+            ("POST", r"/[^/]+/oauth2/v2.0/token", "token", self.token),
+            ("GET", r"/v1.0/sites", "sites", self.sites),
+            ("GET", r"/v1.0/sites/([^/:]+):/sites/([^/]+)", "site_by_path", self.site_by_path),
+            ("GET", r"/v1.0/sites/([^/]+)/drives", "drives", self.drives),
+            ("GET", r"/v1.0/sites/[^/]+/drives/([^/]+)/root/children", "children", self.children),
+            ("GET", r"/v1.0/sites/[^/]+/drives/([^/]+)/items/([^/]+)/children", "children", self.children),
+            ("GET", r"/v1.0/drives/([^/]+)/root", "item", self.item),
+            ("GET", r"/v1.0/drives/([^/]+)/items/([^/:]+)", "item", self.item),
+            ("GET", r"/v1.0/drives/([^/]+)/items/([^/:]+):/(.+):", "item", self.item),
+            ("DELETE", r"/v1.0/drives/([^/]+)/items/([^/:]+)", "delete", self.delete),
+            ("PUT", r"/v1.0/drives/([^/]+)/items/([^/:]+)/content", "upload", self.upload),
+            ("PUT", r"/v1.0/drives/([^/]+)/items/([^/:]+):/(.+):/content", "upload", self.upload),
+            ("POST", r"/v1.0/drives/([^/]+)/items/([^/:]+)/createUploadSession", "upload_session",
+             self.create_upload_session),
+            ("POST", r"/v1.0/drives/([^/]+)/items/([^/:]+):/(.+):/createUploadSession", "upload_session",
+             self.create_upload_session),
+            ("PUT", r"/upload/(\d+)", "upload_fragment", self.upload_fragment),
+            ("GET", r"/upload/(\d+)", "upload_status", self.upload_status),
+            ("GET", r"/download/([^/]+)/([^/]+)", "download", self.download),
+            ("GET", r"/v1.0/sites/[^/]+/lists", "lists", self.lists),
+            ("GET", r"/v1.0/sites/[^/]+/lists/([^/]+)/items", "list_items", self.list_items),
+        ]
+        for route_method, pattern, endpoint, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                return endpoint, handler, match.groups()
+        return "unknown", None, ()
+
+    def token(self, query):
+        self.read_body()
+        self.send_json({"token_type": "Bearer", "expires_in": 3600, "access_token": "benchmark-token"})
+
+    def sites(self, query):
+        search = query.get("search", [None])[0]
+        values = [{"id": self.graph.site_id, "name": self.graph.site_name, "webUrl": "https://{}/sites/{}".format(
+            self.graph.hostname, self.graph.site_name), "siteCollection": {"hostname": self.graph.hostname}}]
+        if search and search != self.graph.site_name:
+            values = []
+        self.send_json({"value": values})
+
+    def site_by_path(self, query, hostname, site_name):
+        if site_name != self.graph.site_name:
+            return self.send_error_json(404, "itemNotFound")
+        self.send_json({"id": self.graph.site_id, "name": site_name})
+
+    def drives(self, query, site_id):
+        self.send_json({"value": [{"id": library.drive_id, "name": library.name, "webUrl": "https://{}/sites/{}/{}".format(
+            self.graph.hostname, self.graph.site_name, library.name)} for library in self.graph.libraries.values()]})
+
+    def children(self, query, drive_id, item_id=None):
+        library = self.graph.libraries[drive_id]
+        folder = library.items[item_id] if item_id else library.root
+        values = [self.graph.drive_item(library, library.items[child_id]) for child_id in folder["children"]]
+        self.send_json(page(values, query, self.graph.origin + self.path))
+
+    def item(self, query, drive_id, item_id=None, file_name=None):
+        library = self.graph.libraries.get(drive_id)
+        item = library.items.get(item_id) if item_id else library.root
+        if item is not None and file_name:
+            item = library.find_child(item_id, file_name)
+        if item is None:
+            return self.send_error_json(404, "itemNotFound")
+        self.send_json(self.graph.drive_item(library, item))
+
+    def delete(self, query, drive_id, item_id):
+        if_match = self.headers.get("If-Match")
+        library = self.graph.libraries[drive_id]
+        if item_id not in library.items:
+            return self.send_error_json(404, "itemNotFound")
+        if if_match and if_match != self.graph.drive_item(library, library.items[item_id])["eTag"]:
+            return self.send_error_json(412, "preconditionFailed")
+        item = library.items.pop(item_id)
+        library.items[item["parent"]]["children"].remove(item_id)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def store(self, drive_id, item_id, file_name, size):
+        """ Create file_name under item_id, or replace item_id when file_name is None """
+        library = self.graph.libraries[drive_id]
+        with self.graph.lock:
+            item = library.find_child(item_id, file_name) if file_name else library.items[item_id]
+            if item is None:
+                item = library.add_item(item_id, file_name, size)
+            else:
+                item["size"] = size
+                item["version"] += 1
+        return library, item
+
+    def upload(self, query, drive_id, item_id, file_name=None):
+        if_match = self.headers.get("If-Match")
+        library = self.graph.libraries[drive_id]
+        if if_match and not file_name and if_match != self.graph.drive_item(library, library.items[item_id])["eTag"]:
+            self.read_body()
+            return self.send_error_json(412, "preconditionFailed")
+        data = self.read_body()
+        library, item = self.store(drive_id, item_id, file_name, len(data))
+        self.send_json(self.graph.drive_item(library, item), 201 if file_name else 200)
+
+    def create_upload_session(self, query, drive_id, item_id, file_name=None):
+        self.read_body()
+        with self.graph.lock:
+            session_id = str(next(self.graph.session_ids))
+            self.graph.upload_sessions[session_id] = {"driveId": drive_id, "itemId": item_id, "name": file_name,
+                                                      "received": 0}
+        self.send_json({"uploadUrl": "{}/upload/{}".format(self.graph.origin, session_id),
+                        "expirationDateTime": "2099-01-01T00:00:00Z"})
+
+    def upload_status(self, query, session_id):
+        session = self.graph.upload_sessions.get(session_id)
+        if session is None:
+            return self.send_error_json(404, "itemNotFound")
+        self.send_json({"nextExpectedRanges": ["{}-".format(session["received"])]})
+
+    def upload_fragment(self, query, session_id):
+        session = self.graph.upload_sessions.get(session_id)
+        if session is None:
+            self.read_body()
+            return self.send_error_json(404, "itemNotFound")
+        start, end, total = map(int, re.match(r"bytes (\d+)-(\d+)/(\d+)",
+                                              self.headers["Content-Range"]).groups())
+        data = self.read_body()
+        if start != session["received"] or len(data) != end - start + 1:
+            return self.send_error_json(416, "invalidRange")
+        session["received"] = end + 1
+        if session["received"] < total:
+            return self.send_json({"nextExpectedRanges": ["{}-".format(session["received"])]}, 202)
+        del self.graph.upload_sessions[session_id]
+        library, item = self.store(session["driveId"], session["itemId"], session["name"], total)
+        self.send_json(self.graph.drive_item(library, item), 201)
+
+    def download(self, query, drive_id, item_id):
+        item = self.graph.libraries[drive_id].items.get(item_id)
+        if item is None:
+            return self.send_error_json(404, "itemNotFound")
+        size = item["size"]
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        else:
+            self.send_response(200)
+        length = end - start + 1
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        cut_at = length // 2 if length > 1 and self.graph.faults.draw(self.graph.faults.disconnect_rate) else None
+        position = start
+        while position <= end:
+            if cut_at is not None and position - start >= cut_at:
+                with self.graph.lock:
+                    self.graph.disconnected += 1
+                self.close_connection = True
+                return
+            offset = position % len(CONTENT_BLOCK)
+            remaining = end - position + 1 if cut_at is None else start + cut_at - position
+            chunk = CONTENT_BLOCK[offset:offset + min(WRITE_CHUNK_SIZE, remaining)]
+            self.wfile.write(chunk)
+            position += len(chunk)
+            with self.graph.lock:
+                self.graph.bytes_sent += len(chunk)
+            self.pace(len(chunk))
+
+    def lists(self, query):
+        self.send_json(page([{"id": list_id, "name": list_info["name"]}
+                             for list_id, list_info in self.graph.lists.items()], query,
+                            self.graph.origin + self.path))
+
+    def list_items(self, query, list_id):
+        list_info = self.graph.lists.get(list_id)
+        if list_info is None:
+            return self.send_error_json(404, "itemNotFound")
+        select = re.match(r"fields\(select=([^)]*)\)", query.get("expand", ["fields"])[0])
+        items = list_info["items"]
+        if select:
+            columns = select.group(1).split(",")
+            items = [{"id": item["id"], "fields": {column: item["fields"].get(column) for column in columns}}
+                     for item in items]
+        self.send_json(page(items, query, self.graph.origin + self.path))
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients drop connections after injected disconnects, that is expected
+        pass
+
+
+class FakeGraphServer:
+    """ Serves graph on a local port in a background thread. base_url and token_url are the client
+    config values that point SharePointClient at it """
+    def __init__(self, graph, host="127.0.0.1", port=0):
+        handler = type("BoundGraphHandler", (GraphHandler,), {"graph": graph})
+        self.graph = graph
+        self.server = QuietHTTPServer((host, port), handler)
+        self.origin = "http://{}:{}".format(*self.server.server_address[:2])
+        graph.origin = self.origin
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return self.origin + "/v1.0"
+
+    @property
+    def token_url(self):
+        return self.origin + "/benchmark/oauth2/v2.0/token"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
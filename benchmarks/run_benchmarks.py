@@ -0,0 +1,192 @@
+""" Offline benchmarks of SharePointClient against the local Graph stand-in of fake_graph.py.
+
+    python benchmarks/run_benchmarks.py --scenario all --latency 0.005 --throttle_rate 0.02
+
+Each scenario runs in a fresh process so its peak RSS is its own, and reports files/s, MB/s,
+requests issued and peak RSS """
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_graph import FakeGraph, FakeGraphServer, Faults, CONTENT_BLOCK
+
+SCENARIOS = ["listing", "download", "upload", "items"]
+LIBRARIES = {"listing": "Deep", "download": "Files", "upload": "Uploads"}
+LIST_NAME = "Tracking"
+MB = 1000 * 1000
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes, ru_maxrss is in KiB on Linux and bytes on macOS """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def client_config(server, args):
+    return {
+        "tenant_name": "benchmark",
+        "client_id": "benchmark",
+        "client_secret": "benchmark",
+        "grant_type": "client_credentials",
+        "scope": "https://graph.microsoft.com/.default",
+        "site_name": server.graph.site_name,
+        "base_url": server.base_url,
+        "token_url": server.token_url,
+        "max_workers": args.max_workers,
+        "page_size": args.page_size,
+        "progress": "none",
+        "backoff_base": 0.05,
+        "backoff_max": 1,
+        "max_retries": 8
+    }
+
+
+def build_graph(args):
+    graph = FakeGraph(faults=Faults(latency=args.latency, bandwidth=args.bandwidth, throttle_rate=args.throttle_rate,
+                                    retry_after=args.retry_after, disconnect_rate=args.disconnect_rate,
+                                    seed=args.seed))
+    graph.add_folder_tree(graph.add_library(LIBRARIES["listing"]), args.depth, args.fanout, args.files_per_folder,
+                          args.small_size)
+    files = graph.add_library(LIBRARIES["download"])
+    graph.add_small_files(files, args.small_files, args.small_size)
+    graph.add_huge_files(files, args.huge_files, args.huge_size)
+    graph.add_library(LIBRARIES["upload"])
+    graph.add_list(LIST_NAME, args.list_items)
+    return graph
+
+
+def write_local_files(path, args):
+    for number in range(args.small_files):
+        with open(os.path.join(path, "small_{:06d}.bin".format(number)), 'wb') as f:
+            f.write(CONTENT_BLOCK[:args.small_size])
+    for number in range(args.huge_files):
+        with open(os.path.join(path, "huge_{:03d}.bin".format(number)), 'wb') as f:
+            remaining = args.huge_size
+            while remaining:
+                remaining -= f.write(CONTENT_BLOCK[:min(remaining, len(CONTENT_BLOCK))])
+    return args.small_files + args.huge_files, args.small_files * args.small_size + args.huge_files * args.huge_size
+
+
+def run_scenario(scenario, config, work_path, results):
+    """ Runs in a child process, puts (files, bytes, seconds, peak RSS) on results """
+    import sharepoint_document_library as cli
+    from sharepoint_document_library.client import SharePointClient
+    # transfers log every file at INFO and every retry at WARNING, the report counts them instead
+    logging.getLogger().setLevel(logging.ERROR)
+
+    config = dict(config, document_library=LIBRARIES.get(scenario))
+    files = size = 0
+    started = time.perf_counter()
+    with SharePointClient(config) as client:
+        site_id, _ = client.getSiteId(config["site_name"])
+        if scenario == "listing":
+            drive_id, _ = client.getDrivesId(site_id, config["document_library"])
+            for item in client.crawlDriveItems(site_id, drive_id):
+                files += 1
+        elif scenario == "download":
+            drive_id, _ = client.getDrivesId(site_id, config["document_library"])
+            file_items = list(cli.iter_file_items(client.iterDriveItems(site_id, drive_id), work_path))
+            transfers = cli.download_file_items(client, file_items, work_path, max_workers=client.max_workers)
+            files = sum(1 for result in transfers.values() if result is True)
+            size = sum(item["size"] for item in file_items)
+        elif scenario == "upload":
+            transfers = cli.upload_files(client, config, work_path + "/", max_workers=client.max_workers)
+            files = sum(1 for result in transfers.values() if result is True)
+            size = sum(os.path.getsize(os.path.join(work_path, name)) for name in os.listdir(work_path))
+        elif scenario == "items":
+            files = len(client.getItems(site_id, LIST_NAME))
+    results.put((files, size, time.perf_counter() - started, peak_rss()))
+
+
+def benchmark(scenario, server, args):
+    work_path = tempfile.mkdtemp(prefix="sharepoint-benchmark-")
+    try:
+        if scenario == "upload":
+            write_local_files(work_path, args)
+        server.graph.reset_counters()
+        # spawn, so the peak RSS measured is not inherited from this process
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        process = context.Process(target=run_scenario,
+                                  args=(scenario, client_config(server, args), work_path, results))
+        process.start()
+        files, size, seconds, rss = results.get()
+        process.join()
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    counters = server.graph.counters()
+    return {
+        "scenario": scenario,
+        "files": files,
+        "mb": size / MB,
+        "seconds": seconds,
+        "files_per_second": files / seconds,
+        "mb_per_second": size / MB / seconds,
+        "requests": counters["requests"],
+        "throttled": counters["throttled"],
+        "disconnected": counters["disconnected"],
+        "peak_rss_mb": rss / MB,
+        "by_endpoint": counters["by_endpoint"]
+    }
+
+
+def format_report(reports):
+    header = "{:<10} {:>8} {:>9} {:>8} {:>9} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        "scenario", "files", "MB", "seconds", "files/s", "MB/s", "requests", "throttled", "cut", "RSS MB")
+    lines = [header, "-" * len(header)]
+    for report in reports:
+        lines.append("{scenario:<10} {files:>8} {mb:>9.1f} {seconds:>8.2f} {files_per_second:>9.1f} "
+                     "{mb_per_second:>8.1f} {requests:>9} {throttled:>9} {disconnected:>9} "
+                     "{peak_rss_mb:>9.1f}".format(**report))
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark SharePointClient against a local Graph stand-in")
+    parser.add_argument('--scenario', choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument('--max_workers', type=int, default=8)
+    parser.add_argument('--page_size', type=int, default=200)
+    parser.add_argument('--small_files', type=int, default=1000, help='Small files to download and upload')
+    parser.add_argument('--small_size', type=int, default=16 * 1024)
+    parser.add_argument('--huge_files', type=int, default=2, help='Huge files to download and upload')
+    parser.add_argument('--huge_size', type=int, default=128 * 1024 * 1024)
+    parser.add_argument('--depth', type=int, default=4, help='Depth of the folder tree that is listed')
+    parser.add_argument('--fanout', type=int, default=4, help='Subfolders per folder of the listed tree')
+    parser.add_argument('--files_per_folder', type=int, default=50)
+    parser.add_argument('--list_items', type=int, default=20000, help='Items of the list read with getItems')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bytes/s cap of each transfer')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='Share of requests answered with 429')
+    parser.add_argument('--retry_after', type=float, default=0.1, help='Retry-After of throttled requests')
+    parser.add_argument('--disconnect_rate', type=float, default=0.0, help='Share of downloads cut off half way')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the reports to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    graph = build_graph(args)
+    scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+    with FakeGraphServer(graph) as server:
+        reports = [benchmark(scenario, server, args) for scenario in scenarios]
+    print(format_report(reports))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,10 @@ setup(
         "requests",
         "tqdm"
     ],
+    extras_require={
+        "async": ["aiohttp"],
+        "encryption": ["cryptography"]
+    },
     entry_points='''
     [console_scripts]
     sharepoint-document-library=sharepoint_document_library:main
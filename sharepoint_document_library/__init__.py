@@ -1,10 +1,20 @@
 from sharepoint_document_library.utils import parse_args
-from sharepoint_document_library.client import SharePointClient
+from sharepoint_document_library.client import SharePointClient, SharepointError, PreconditionFailed
+from sharepoint_document_library.manifest import SyncManifest
+from sharepoint_document_library.hashing import hash_file, compare_hashes
+from sharepoint_document_library.export import export_items
+from sharepoint_document_library import planner
+from sharepoint_document_library.progress import SharedProgressTask
+import os
+import time
+import shutil
+import hashlib
 import logging
+import itertools
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sharepoint_document_library import utils
 
-logging.basicConfig(level = logging.INFO)
-
 REQUIRED_CONFIG_KEYS = [
     'tenant_name',
     'client_id',
@@ -14,66 +24,623 @@ REQUIRED_CONFIG_KEYS = [
     'site_name'
 ]
 
-def download_files(client, config, download_path):
-    document_library = config.get('document_library', None)
-    site_name = config['site_name']
-    if document_library:
-        site_id, _ = client.getSiteId(site_name)
-        drive_id, drive_web_url = client.getDrivesId(site_id, document_library)
-        file_items_info, folder_items_info = client.getFileAndFolderItems(site_id, drive_id)
+def get_local_path(download_path, item_info):
+    return download_path + '/' + item_info.get("relativePath", item_info["name"])
+
+
+def iter_file_items(items_info, download_path):
+    """ Mirror folders under download_path and yield only the file items """
+    for item_info in items_info:
+        if "file" in item_info:
+            yield item_info
+        elif "folder" in item_info:
+            os.makedirs(get_local_path(download_path, item_info), exist_ok=True)
+
+
+def get_relative_path(item_info, paths):
+    """ Path of a drive item below the library root, built from the path of its parent folder in paths.
+    Delta responses carry no parentReference.path, a parent folder is returned before its children.
+    None when the parent folder is not known """
+    parent_path = paths.get(item_info.get("parentReference", {}).get("id"))
+    if parent_path is None:
+        return None
+    return parent_path + '/' + item_info["name"] if parent_path else item_info["name"]
+
+
+def iter_descendant_ids(paths, folder_path):
+    prefix = folder_path + '/'
+    return [item_id for item_id, path in paths.items() if path.startswith(prefix)]
+
+
+def remove_local_path(download_path, relative_path):
+    local_path = download_path + '/' + relative_path
+    if os.path.isdir(local_path):
+        shutil.rmtree(local_path)
+    elif os.path.exists(local_path):
+        os.remove(local_path)
+    else:
+        return
+    logging.info("'{}' is deleted from local".format(local_path))
+
+
+def move_local_folder(download_path, paths, old_path, new_path):
+    """ Follow a folder renamed or moved remotely. Delta returns only the folder itself, not its
+    descendants, so the local folder is moved and the paths below it are rewritten """
+    for item_id in iter_descendant_ids(paths, old_path):
+        paths[item_id] = new_path + paths[item_id][len(old_path):]
+    old_local_path = download_path + '/' + old_path
+    new_local_path = download_path + '/' + new_path
+    if not os.path.isdir(old_local_path):
+        return
+    if os.path.exists(new_local_path):
+        logging.warning("'{}' is not moved to '{}', it already exists".format(old_local_path, new_local_path))
+        return
+    os.makedirs(os.path.dirname(new_local_path), exist_ok=True)
+    os.replace(old_local_path, new_local_path)
+    logging.info("'{}' is moved to '{}'".format(old_local_path, new_local_path))
+
+
+def iter_delta_items(client, drive_id, state, download_path, recursive=False, delete_removed=False):
+    """ Yield items changed since state['deltaLink'] and keep state['paths'] (item id -> relative path,
+    the library root is '') up to date. The new delta link is stored in state['nextDeltaLink'] once
+    all pages are read """
+    if "rootId" not in state:
+        # paths saved without the root id were built from parentReference.path, list the whole library again
+        state.update(deltaLink=None, paths={}, rootId=client.getDriveRoot(drive_id)["id"])
+    paths = state["paths"]
+    paths[state["rootId"]] = ''
+    pages = client.iterDeltaPages(drive_id, state["deltaLink"])
+    try:
+        first_page = next(pages)
+    except SharepointError as error:
+        if not state["deltaLink"]:
+            raise
+        # delta links expire (410 Gone), start over with a full enumeration
+        logging.warning("Delta link is no longer valid, listing the whole library again: {}".format(error))
+        pages = client.iterDeltaPages(drive_id)
+        first_page = next(pages)
+    for values, delta_link in itertools.chain([first_page], pages):
+        for item_info in values:
+            if "root" in item_info:
+                continue
+            old_path = paths.get(item_info["id"])
+            if "deleted" in item_info:
+                paths.pop(item_info["id"], None)
+                if old_path:
+                    for item_id in iter_descendant_ids(paths, old_path):
+                        del paths[item_id]
+                    if delete_removed:
+                        remove_local_path(download_path, old_path)
+                continue
+            relative_path = get_relative_path(item_info, paths)
+            if relative_path is None:
+                logging.warning("Parent folder of '{}' is unknown, skipping it".format(item_info["name"]))
+                continue
+            item_info["relativePath"] = relative_path
+            # folders are tracked even when not recursive, so the paths of later items resolve
+            paths[item_info["id"]] = relative_path
+            if old_path and old_path != relative_path:
+                # item was renamed or moved
+                if "folder" in item_info:
+                    move_local_folder(download_path, paths, old_path, relative_path)
+                elif delete_removed:
+                    remove_local_path(download_path, old_path)
+            if not recursive and '/' in relative_path:
+                continue
+            if "file" in item_info and "@microsoft.graph.downloadUrl" not in item_info:
+                item_info = dict(client.getDriveItem(drive_id, item_info["id"]), relativePath=relative_path)
+            yield item_info
+        if delta_link:
+            state["nextDeltaLink"] = delta_link
+
+
+def download_file_item(client, file_item_info, download_path, show_progress=True, progress=None):
+    """ progress is the sink of the transfer instead of the client progress, e.g. a share of the
+    aggregate progress of a pool of downloads """
+    url = file_item_info["@microsoft.graph.downloadUrl"]
+    file_path = get_local_path(download_path, file_item_info)
+    file_size = file_item_info["size"]
+    drive_id = file_item_info.get("parentReference", {}).get("driveId")
+
+    def resolve_url():
+        return client.getDriveItem(drive_id, file_item_info["id"])["@microsoft.graph.downloadUrl"]
+
+    with client.tracer.span(file_path, "transfer", size=file_size):
+        downloaded = client.download_file(url, filename=file_path, file_size=file_size, show_progress=show_progress,
+                                          eTag=file_item_info.get("eTag"), resolveUrl=resolve_url if drive_id else None,
+                                          hashes=file_item_info.get("file", {}).get("hashes"), progress=progress)
+    if downloaded:
+        logging.info("'{}' file is downloaded".format(file_path))
+    return file_path, downloaded
+
+
+def open_manifest(config, use_manifest=None):
+    if use_manifest or config.get('manifest', False):
+        return SyncManifest(utils.get_state_file(config, "manifest.sqlite"))
+    return None
+
+
+def skip_current_downloads(manifest, drive_id, file_items_info, download_path):
+    """ Yield only file items whose eTag changed since they were downloaded """
+    for file_item_info in file_items_info:
+        relative_path = file_item_info.get("relativePath", file_item_info["name"])
+        if manifest.is_download_current(drive_id, relative_path, file_item_info,
+                                        get_local_path(download_path, file_item_info)):
+            logging.info("'{}' file is unchanged, skipping download".format(relative_path))
+            continue
+        yield file_item_info
+
+
+def record_download(manifest, drive_id, file_item_info, file_path, downloaded):
+    if manifest is not None and downloaded is True:
+        relative_path = file_item_info.get("relativePath", file_item_info["name"])
+        manifest.record(drive_id, relative_path, file_item_info, file_path)
+
+
+def download_file_items(client, file_items_info, download_path, max_workers=1, manifest=None, drive_id=None,
+                        executor=None):
+    """ Download files with a bounded pool of workers sharing the client session.
+    file_items_info may be a generator, transfers start while it is still being listed.
+    executor is a pool shared with other callers, which then caps their transfers together.
+    Successful downloads are recorded in manifest when given.
+    Returns a dict of local file path -> True/False (or the exception raised) """
+    results = {}
+    if max_workers <= 1 and executor is None:
         for file_item_info in file_items_info:
-            url = file_item_info["@microsoft.graph.downloadUrl"]
-            name = file_item_info["name"]
-            file_path = download_path + '/' + name
-            file_size = file_item_info["size"]
-            client.download_file(url, filename=file_path, file_size=file_size)
-            logging.info("'{}' file is downloaded".format(file_path))
+            try:
+                file_path, downloaded = download_file_item(client, file_item_info, download_path)
+            except Exception as error:
+                file_path = get_local_path(download_path, file_item_info)
+                downloaded = error
+                logging.error("'{}' file is not downloaded: {}".format(file_path, error))
+            results[file_path] = downloaded
+            record_download(manifest, drive_id, file_item_info, file_path, downloaded)
+        return results
+
+    # one progress for the pool, every file adds its bytes to it as they arrive
+    progress = SharedProgressTask(client.progress.start(download_path, 0))
+    with nullcontext(executor) if executor is not None else ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        # spans of the workers belong to the span open here
+        download_item = client.tracer.bind(download_file_item)
+        for file_item_info in file_items_info:
+            size = file_item_info.get("size", 0)
+            future = executor.submit(download_item, client, file_item_info, download_path, False, progress.share(size))
+            futures[future] = file_item_info
+            progress.total += size
+        for future in as_completed(futures):
+            file_item_info = futures[future]
+            file_path = get_local_path(download_path, file_item_info)
+            try:
+                file_path, downloaded = future.result()
+            except Exception as error:
+                downloaded = error
+                logging.error("'{}' file is not downloaded: {}".format(file_path, error))
+            results[file_path] = downloaded
+            record_download(manifest, drive_id, file_item_info, file_path, downloaded)
+    progress.close()
+    return results
+
 
+def log_transfer_summary(results, action="downloaded"):
+    failed = [file_path for file_path, result in results.items() if result is not True]
+    logging.info("{} of {} files are {}".format(len(results) - len(failed), len(results), action))
+    for file_path in failed:
+        logging.error("'{}' file is not {}: {}".format(file_path, action, results[file_path]))
+
+
+def download_library(client, config, site_id, drive_id, download_path, max_workers=1, recursive=False,
+                     incremental=False, delete_removed=False, manifest=None, executor=None):
+    """ Download the files of one document library into download_path """
+    if incremental:
+        state_file = utils.get_state_file(config, "delta_{}.json".format(drive_id))
+        state = utils.load_state(state_file, {"deltaLink": None, "paths": {}})
+        items_info = iter_delta_items(client, drive_id, state, download_path,
+                                      recursive=recursive, delete_removed=delete_removed)
+    elif recursive:
+        items_info = client.crawlDriveItems(site_id, drive_id, max_workers=max_workers)
     else:
-        # TODO: if document library is not specified, get files from all document libraries
-        pass
+        items_info = client.iterDriveItems(site_id, drive_id)
+    file_items_info = iter_file_items(items_info, download_path)
+    if manifest is not None:
+        file_items_info = skip_current_downloads(manifest, drive_id, file_items_info, download_path)
+    # listing is consumed while files are downloaded, so both are one phase
+    with client.tracer.span("list and download", "phase", path=download_path):
+        results = download_file_items(client, file_items_info, download_path, max_workers,
+                                      manifest=manifest, drive_id=drive_id, executor=executor)
+    log_transfer_summary(results)
+    if incremental:
+        # keep the old delta link when a download failed, so the file is picked up by the next run
+        if all(result is True for result in results.values()):
+            state["deltaLink"] = state.pop("nextDeltaLink", state["deltaLink"])
+        state.pop("nextDeltaLink", None)
+        utils.save_state(state_file, state)
+    return results
+
+
+def get_library_path(download_path, site_name, library_name, per_site=False):
+    """ Output directory of a library: <download_path>/<library>, or <download_path>/<site>/<library>
+    when several sites are downloaded """
+    names = [site_name, library_name] if per_site else [library_name]
+    path = os.path.join(download_path, *[name.replace(os.sep, "_") for name in names])
+    os.makedirs(path, exist_ok=True)
+    return path
 
-def upload_files(client, config, upload_path, file_name="file3.png"):
+
+def get_libraries(client, config):
+    """ (site name, site id, drive) of every document library of the sites in site_names,
+    or of site_name when site_names is not set """
+    site_names = config.get('site_names') or [config['site_name']]
+    with client.tracer.span("resolve", "phase"):
+        site_ids = client.getSiteIds(site_names)
+        return [(site_name, site_ids[site_name][0], drive)
+                for site_name in site_names for drive in client.iterDrives(site_ids[site_name][0])]
+
+
+def download_all_libraries(client, config, download_path, max_workers=1, recursive=False, incremental=False,
+                           delete_removed=False, manifest=None):
+    """ Download every document library of the configured sites concurrently. Libraries are listed in
+    parallel while their files share one pool of max_workers transfers, the cap of the whole run """
+    libraries = get_libraries(client, config)
+    per_site = len(set(site_name for site_name, site_id, drive in libraries)) > 1
+    logging.info("Downloading {} document libraries".format(len(libraries)))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor, \
+            ThreadPoolExecutor(max_workers=max(1, min(len(libraries), max_workers))) as library_executor:
+        futures = {}
+        run_library = client.tracer.bind(download_library)
+        for site_name, site_id, drive in libraries:
+            library_path = get_library_path(download_path, site_name, drive["name"], per_site)
+            future = library_executor.submit(run_library, client, config, site_id, drive["id"], library_path,
+                                             max_workers, recursive, incremental, delete_removed, manifest, executor)
+            futures[future] = library_path
+        for future in as_completed(futures):
+            try:
+                results.update(future.result())
+            except Exception as error:
+                logging.error("'{}' library is not downloaded: {}".format(futures[future], error))
+                results[futures[future]] = error
+    return results
+
+
+def download_files(client, config, download_path, max_workers=None, recursive=None, incremental=None,
+                   delete_removed=None, use_manifest=None):
+    """ Download document_library, or every document library of the site (and of site_names) when
+    document_library is not set """
+    document_library = config.get('document_library', None)
+    site_name = config['site_name']
+    max_workers = max_workers or int(config.get('max_workers', 1))
+    recursive = recursive or config.get('recursive', False)
+    incremental = incremental or config.get('incremental', False)
+    delete_removed = delete_removed or config.get('delete_removed', False)
+    manifest = open_manifest(config, use_manifest)
+    try:
+        if document_library:
+            with client.tracer.span("resolve", "phase"):
+                site_id, _ = client.getSiteId(site_name)
+                drive_id, drive_web_url = client.getDrivesId(site_id, document_library)
+            return download_library(client, config, site_id, drive_id, download_path, max_workers, recursive,
+                                    incremental, delete_removed, manifest)
+        results = download_all_libraries(client, config, download_path, max_workers, recursive, incremental,
+                                         delete_removed, manifest)
+        log_transfer_summary(results)
+        return results
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+
+def get_upload_current_check(client, manifest, drive_id, upload_path):
+    """ is_current check for plan_upload, from the manifest and, with verify_hashes, the content hashes.
+    It only answers, skipped files are recorded in the manifest once the plan is executed """
+    def is_current(file_name, file_item_info):
+        if manifest is not None and manifest.is_upload_current(
+                drive_id, file_name, upload_path + file_name, file_item_info):
+            return "unchanged since the last upload"
+        if client.verify_hashes and compare_hashes(
+                hash_file(upload_path + file_name, client.hash_algorithms), file_item_info):
+            return "identical to the remote copy"
+        return None
+    return is_current
+
+
+def upload_plan_action(client, drive_id, upload_path, action):
+    file_path = upload_path + action["name"]
+    with client.tracer.span(file_path, "transfer", action=action["action"]):
+        if action["action"] == planner.CREATE:
+            result_item = client.upload_local_file(drive_id, file_path, parentID=action["parentId"],
+                                                   filename=action["name"])
+            logging.info("'{}' new file is uploaded".format(file_path))
+        elif action["action"] == planner.REPLACE:
+            result_item = client.upload_local_file(drive_id, file_path, itemId=action["itemId"])
+            logging.info("'{}' existing file is replaced".format(file_path))
+        else:
+            client.delete_item(drive_id, action["itemId"])
+            logging.info("'{}' remote file is deleted".format(action["name"]))
+            result_item = None
+    return result_item
+
+
+def execute_upload_plan(client, drive_id, plan, upload_path, max_workers=1, manifest=None):
+    """ Run the create, replace and delete actions of an upload plan with a bounded pool of workers.
+    Returns a dict of file path -> True (or the exception raised) """
+    results = {}
+    actions = [action for action in plan if action["action"] != planner.SKIP]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        run_action = client.tracer.bind(upload_plan_action)
+        futures = {executor.submit(run_action, client, drive_id, upload_path, action): action for action in actions}
+        for future in as_completed(futures):
+            action = futures[future]
+            file_path = upload_path + action["name"]
+            try:
+                result_item = future.result()
+            except Exception as error:
+                results[file_path] = error
+                logging.error("'{}' file is not {}d: {}".format(file_path, action["action"], error))
+                continue
+            results[file_path] = True
+            if manifest is not None:
+                if action["action"] == planner.DELETE:
+                    manifest.remove(drive_id, action["name"])
+                else:
+                    manifest.record(drive_id, action["name"], result_item, file_path)
+    return results
+
+
+def upload_files(client, config, upload_path, file_name="file3.png", use_manifest=None, max_workers=None,
+                 dry_run=None, delete_remote=None):
+    """ Plan the upload against the remote listing first, then execute the plan.
+    With dry_run the plan is printed as JSON and nothing is transferred """
     file_names = utils.get_file_names(upload_path)
     document_library = config.get('document_library', None)
     site_name = config['site_name']
+    max_workers = max_workers or int(config.get('max_workers', 1))
+    dry_run = dry_run or config.get('dry_run', False)
+    delete_remote = delete_remote or config.get('delete_remote', False)
     if document_library:
+        with client.tracer.span("resolve", "phase"):
+            site_id, _ = client.getSiteId(site_name)
+            drive_id, drive_web_url = client.getDrivesId(site_id, document_library)
+            parent_id = client.getDriveRoot(drive_id)["id"]
+        with client.tracer.span("list", "phase"):
+            file_items_info = list(client.iterDriveItems(site_id, drive_id))
+        manifest = open_manifest(config, use_manifest)
+        try:
+            with client.tracer.span("plan", "phase"):
+                is_current = get_upload_current_check(client, manifest, drive_id, upload_path)
+                plan = planner.plan_upload(file_names, file_items_info, parent_id, is_current, delete_remote)
+            planner.log_plan(plan)
+            if dry_run:
+                print(planner.dump_plan(plan))
+                return plan
+            if manifest is not None:
+                remote_index = {file_item_info["name"]: file_item_info for file_item_info in file_items_info}
+                for action in plan:
+                    if action["action"] == planner.SKIP:
+                        manifest.record(drive_id, action["name"], remote_index[action["name"]],
+                                        upload_path + action["name"])
+            with client.tracer.span("upload", "phase"):
+                results = execute_upload_plan(client, drive_id, plan, upload_path, max_workers, manifest)
+        finally:
+            if manifest is not None:
+                manifest.close()
+        log_transfer_summary(results, action="uploaded")
+        return results
+    # TODO: Implement upload for folders
+
+def get_conflict_name(file_name):
+    stem, extension = os.path.splitext(file_name)
+    return "{} (conflict {}){}".format(stem, time.strftime("%Y%m%d-%H%M%S"), extension)
+
+
+def sync_download(client, drive_id, sync_path, file_item_info):
+    file_path, downloaded = download_file_item(client, file_item_info, sync_path, show_progress=False)
+    if not downloaded:
+        raise SharepointError("'{}' file is not downloaded".format(file_path))
+    return [(file_item_info["name"], file_item_info)]
+
+
+def sync_keep_both(client, drive_id, sync_path, action, file_item_info):
+    """ Keep the local version under a conflict name on both sides and download the remote version """
+    conflict_name = get_conflict_name(action["name"])
+    file_path = os.path.join(sync_path, action["name"])
+    conflict_path = os.path.join(sync_path, conflict_name)
+    os.replace(file_path, conflict_path)
+    result_item = client.upload_local_file(drive_id, conflict_path, parentID=action["parentId"],
+                                           filename=conflict_name)
+    logging.warning("'{}' changed on both sides, the local version is kept as '{}'".format(file_path, conflict_name))
+    return [(conflict_name, result_item)] + sync_download(client, drive_id, sync_path, file_item_info)
+
+
+def sync_plan_action(client, drive_id, sync_path, action, file_item_info, conflict_policy):
+    """ Run one action of a sync plan, returns the (name, drive item) pairs to record in the manifest,
+    with None as the drive item of a deleted file """
+    file_path = os.path.join(sync_path, action["name"])
+    if action["action"] == planner.DELETE_LOCAL:
+        os.remove(file_path)
+        logging.info("'{}' is deleted from local, it was deleted in Sharepoint".format(file_path))
+        return [(action["name"], None)]
+    if action["action"] == planner.DELETE:
+        try:
+            client.delete_item(drive_id, action["itemId"], eTag=action["eTag"])
+        except PreconditionFailed:
+            # changed remotely after it was listed, the remote version is kept
+            file_item_info = client.getDriveItem(drive_id, action["itemId"])
+            logging.warning("'{}' changed in Sharepoint after it was deleted locally, downloading it again".format(
+                file_path))
+            return sync_download(client, drive_id, sync_path, file_item_info)
+        logging.info("'{}' remote file is deleted, it was deleted from local".format(action["name"]))
+        return [(action["name"], None)]
+    if action["action"] == planner.CONFLICT:
+        if conflict_policy == planner.REMOTE_WINS:
+            logging.warning("'{}' changed on both sides, keeping the remote version".format(file_path))
+            return sync_download(client, drive_id, sync_path, file_item_info)
+        if conflict_policy == planner.KEEP_BOTH:
+            return sync_keep_both(client, drive_id, sync_path, action, file_item_info)
+        logging.warning("'{}' changed on both sides, keeping the local version".format(file_path))
+        return [(action["name"], client.upload_local_file(drive_id, file_path, itemId=action["itemId"]))]
+    if action["action"] == planner.DOWNLOAD:
+        return sync_download(client, drive_id, sync_path, file_item_info)
+    if action["action"] == planner.CREATE:
+        result_item = client.upload_local_file(drive_id, file_path, parentID=action["parentId"],
+                                               filename=action["name"])
+        logging.info("'{}' new file is uploaded".format(file_path))
+        return [(action["name"], result_item)]
+    try:
+        # If-Match makes the upload fail when the remote file changed after it was listed
+        result_item = client.upload_local_file(drive_id, file_path, itemId=action["itemId"], eTag=action["eTag"])
+    except PreconditionFailed:
+        file_item_info = client.getDriveItem(drive_id, action["itemId"])
+        return sync_plan_action(client, drive_id, sync_path, dict(action, action=planner.CONFLICT),
+                                file_item_info, conflict_policy)
+    logging.info("'{}' existing file is replaced".format(file_path))
+    return [(action["name"], result_item)]
+
+
+def get_sync_manifest_file(config, drive_id, sync_path):
+    """ Manifest of the syncs of one local directory with one drive. Rows written by downloads,
+    uploads or the sync of another directory must never be taken for the last sync of this one,
+    so a first sync starts without rows and deletes nothing """
+    sync_key = hashlib.sha256("{}|{}".format(drive_id, os.path.realpath(sync_path)).encode()).hexdigest()
+    return utils.get_state_file(config, "sync_{}.sqlite".format(sync_key[:16]))
+
+
+def sync_files(client, config, sync_path, max_workers=None, conflict_policy=None, dry_run=None):
+    """ Two-way sync of sync_path with the root folder of the document library. Changes are detected
+    against the manifest of the last sync: only the side that changed is transferred, and files
+    changed on both sides are resolved by conflict_policy (remote, local or keep_both) """
+    document_library = config.get('document_library', None)
+    site_name = config['site_name']
+    max_workers = max_workers or int(config.get('max_workers', 1))
+    conflict_policy = conflict_policy or config.get('conflict_policy', planner.REMOTE_WINS)
+    dry_run = dry_run or config.get('dry_run', False)
+    if conflict_policy not in planner.CONFLICT_POLICIES:
+        raise Exception("Unknown conflict_policy '{}', expected one of {}".format(
+            conflict_policy, list(planner.CONFLICT_POLICIES)))
+    if not document_library:
+        raise Exception("Coundn't sync, document_library is not specified")
+    with client.tracer.span("resolve", "phase"):
         site_id, _ = client.getSiteId(site_name)
         drive_id, drive_web_url = client.getDrivesId(site_id, document_library)
-        file_items_info, folder_items_info = client.getFileAndFolderItems(site_id, drive_id)
-        for file_name in file_names:
-            for file_item_info in file_items_info:
-                if file_item_info["name"] == file_name:
-                    item_id = file_item_info["id"]
-                    data = utils.open_file(upload_path + file_name)
-                    result_item = client.upload_file(drive_id, data, itemId=item_id)
-                    logging.info("'{}' existing file is replaced".format(upload_path + file_name))
-                    break
-            else:
-                parent_id = file_item_info["parentReference"]["id"]
-                data = utils.open_file(upload_path + file_name)
-                result_item = client.upload_file(drive_id, data, parentID=parent_id, filename=file_name)
-                logging.info("'{}' new file is uploaded".format(upload_path + file_name))
-    # TODO: Implement upload for folders
-    # TODO: Implement upload for bigger files (>4mb)
+        parent_id = client.getDriveRoot(drive_id)["id"]
+    with client.tracer.span("list", "phase"):
+        file_items_info = {file_item_info["name"]: file_item_info
+                           for file_item_info in client.iterDriveItems(site_id, drive_id) if "file" in file_item_info}
+    results = {}
+    # sync always keeps a manifest, it is the common ancestor both sides are compared with
+    with SyncManifest(get_sync_manifest_file(config, drive_id, sync_path)) as manifest:
+
+        def is_identical(file_name, file_item_info):
+            return client.verify_hashes and bool(compare_hashes(
+                hash_file(os.path.join(sync_path, file_name), client.hash_algorithms), file_item_info))
+
+        with client.tracer.span("plan", "phase"):
+            plan = planner.plan_sync(utils.get_file_names(sync_path), file_items_info.values(), parent_id,
+                                     get_row=lambda file_name: manifest.get(drive_id, file_name),
+                                     is_local_unchanged=lambda row, file_name: manifest.is_local_unchanged(
+                                         row, os.path.join(sync_path, file_name)),
+                                     is_identical=is_identical)
+        planner.log_plan(plan, "Sync")
+        if dry_run:
+            print(planner.dump_plan(plan))
+            return plan
+        for action in plan:
+            if action["action"] == planner.SKIP and action.get("reason"):
+                manifest.record(drive_id, action["name"], file_items_info[action["name"]],
+                                os.path.join(sync_path, action["name"]))
+        actions = [action for action in plan if action["action"] != planner.SKIP]
+        with client.tracer.span("sync", "phase"), ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            run_action = client.tracer.bind(sync_plan_action)
+            futures = {executor.submit(run_action, client, drive_id, sync_path, action,
+                                       file_items_info.get(action["name"]), conflict_policy): action
+                       for action in actions}
+            for future in as_completed(futures):
+                action = futures[future]
+                file_path = os.path.join(sync_path, action["name"])
+                try:
+                    synced_items = future.result()
+                except Exception as error:
+                    results[file_path] = error
+                    continue
+                results[file_path] = True
+                for name, item_info in synced_items:
+                    if item_info is None:
+                        manifest.remove(drive_id, name)
+                    else:
+                        manifest.record(drive_id, name, item_info, os.path.join(sync_path, name))
+    log_transfer_summary(results, action="synced")
+    return results
+
+
+def export_list_items(client, config, list_name, export_path, fields=None, filter=None):
+    site_id, _ = client.getSiteId(config['site_name'])
+    items = client.iterItems(site_id, list_name, fields=fields, filter=filter)
+    return export_items(items, export_path, fields=fields)
 
 def main():
+    # configured here rather than at import, so applications using the package keep their own logging setup
+    logging.basicConfig(level = logging.INFO)
     parsed_args = parse_args(REQUIRED_CONFIG_KEYS)
+    if parsed_args.progress:
+        parsed_args.config['progress'] = parsed_args.progress
+    if parsed_args.verify_hashes:
+        parsed_args.config['verify_hashes'] = True
+    if parsed_args.token_cache:
+        parsed_args.config['token_cache'] = True
+    if parsed_args.trace_path:
+        parsed_args.config['trace_path'] = parsed_args.trace_path
+    if parsed_args.trace_profile:
+        parsed_args.config['trace_profile'] = True
+    if parsed_args.trace_memory:
+        parsed_args.config['trace_memory'] = True
 
     with SharePointClient(parsed_args.config) as client:
+        try:
+            with client.tracer.span("run", "run"):
+                if parsed_args.download_path:
+                    download_path = parsed_args.download_path
+                    download_files(client=client,
+                                   config=parsed_args.config,
+                                   download_path = download_path,
+                                   max_workers = parsed_args.max_workers,
+                                   recursive = parsed_args.recursive,
+                                   incremental = parsed_args.incremental,
+                                   delete_removed = parsed_args.delete_removed,
+                                   use_manifest = parsed_args.manifest)
+
+                elif parsed_args.upload_path:
+                    upload_path = parsed_args.upload_path
+
+                    upload_files(client=client,
+                                 config=parsed_args.config,
+                                 upload_path = upload_path,
+                                 use_manifest = parsed_args.manifest,
+                                 max_workers = parsed_args.max_workers,
+                                 dry_run = parsed_args.dry_run,
+                                 delete_remote = parsed_args.delete_remote)
+
+                elif parsed_args.sync_path:
+                    sync_files(client=client,
+                               config=parsed_args.config,
+                               sync_path = parsed_args.sync_path,
+                               max_workers = parsed_args.max_workers,
+                               conflict_policy = parsed_args.conflict_policy,
+                               dry_run = parsed_args.dry_run)
 
-        if parsed_args.download_path:
-            download_path = parsed_args.download_path
-            download_files(client=client,
-                           config=parsed_args.config,
-                           download_path = download_path)
+                elif parsed_args.list_name:
+                    export_list_items(client=client,
+                                      config=parsed_args.config,
+                                      list_name = parsed_args.list_name,
+                                      export_path = parsed_args.export_path or parsed_args.list_name + '.ndjson',
+                                      fields = parsed_args.fields.split(',') if parsed_args.fields else None,
+                                      filter = parsed_args.filter)
 
-        elif parsed_args.upload_path:
-            upload_path = parsed_args.upload_path
+        finally:
+            client.metrics.log_summary()
+            metrics_path = parsed_args.metrics_path or parsed_args.config.get('metrics_path')
+            if metrics_path:
+                client.metrics.write_prometheus(metrics_path, parsed_args.config.get('metrics_prefix', 'sharepoint'))
 
-            upload_files(client=client,
-                         config=parsed_args.config,
-                         upload_path = upload_path)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
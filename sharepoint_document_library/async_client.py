@@ -0,0 +1,336 @@
+import os
+import time
+import asyncio
+import logging
+from urllib.parse import unquote, quote
+import aiohttp
+from sharepoint_document_library.client import SharepointError, NotFound, InvalidAuthenticationToken, \
+    RETRY_STATUS_CODES, SIMPLE_UPLOAD_LIMIT, UPLOAD_FRAGMENT_MULTIPLE, DEFAULT_UPLOAD_FRAGMENT_SIZE, \
+    get_exception_for_error_code, backoff_delay, parse_retry_after
+from sharepoint_document_library.cache import ResolutionCache, DEFAULT_CACHE_TTL, get_cache_scope
+from sharepoint_document_library.utils import get_abs_path, map_file, get_state_file
+
+
+class AsyncSharePointClient:
+    """ asyncio counterpart of SharePointClient built on aiohttp, meant for many concurrent
+    small transfers from one process. Use it as an async context manager:
+
+        async with AsyncSharePointClient(config) as client:
+            site_id, _ = await client.getSiteId(site_name)
+    """
+    def __init__(self, config, cache=None):
+        self.tenant_name = config['tenant_name']
+        self.client_id = config['client_id']
+        self.client_secret = config['client_secret']
+        self.grant_type = config['grant_type']
+        self.scope = config['scope']
+
+        # token_url and base_url point the client at another endpoint, e.g. the benchmark stand-in server
+        self.tokenUrl = config.get('token_url',
+                                   "https://login.microsoftonline.com/{}/oauth2/v2.0/token".format(self.tenant_name))
+        self.tokenData = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": self.grant_type,
+            "scope": self.scope
+        }
+        self.baseUrl = config.get('base_url', "https://graph.microsoft.com/v1.0")
+        self.max_connections = int(config.get('max_connections', 100))
+        self.page_size = config.get('page_size', None)
+        self.hostname = config.get('hostname', None)
+        self.max_retries = int(config.get('max_retries', 5))
+        self.request_deadline = float(config.get('request_deadline', 300))
+        self.backoff_base = float(config.get('backoff_base', 1))
+        self.backoff_max = float(config.get('backoff_max', 60))
+        self.token_refresh_margin = int(config.get('token_refresh_margin', 300))
+        self.upload_session_threshold = int(config.get('upload_session_threshold', SIMPLE_UPLOAD_LIMIT))
+        fragment_size = int(config.get('upload_fragment_size', DEFAULT_UPLOAD_FRAGMENT_SIZE))
+        self.upload_fragment_size = max(UPLOAD_FRAGMENT_MULTIPLE,
+                                        fragment_size - fragment_size % UPLOAD_FRAGMENT_MULTIPLE)
+        if cache is None:
+            cache_path = get_state_file(config, "resolution_cache.json") if config.get('cache_on_disk') else None
+            cache = ResolutionCache(ttl=int(config.get('cache_ttl', DEFAULT_CACHE_TTL)), path=cache_path,
+                                    scope=get_cache_scope(self.tenant_name, self.baseUrl))
+        self.cache = cache
+        self.session = None
+        self.tokenLock = None
+        self.accessToken = None
+        self.expiresAt = 0
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        self.tokenLock = asyncio.Lock()
+        await self.getAccessToken()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    def isTokenValid(self):
+        return self.accessToken is not None and time.time() < self.expiresAt - self.token_refresh_margin
+
+    async def getAccessToken(self):
+        if not self.isTokenValid():
+            async with self.tokenLock:
+                # another task may have refreshed the token while this one was waiting for the lock
+                if not self.isTokenValid():
+                    async with self.session.post(self.tokenUrl, data=self.tokenData) as response:
+                        if response.status != 200:
+                            logging.error('Error status_code = {}'.format(response.status))
+                            raise InvalidAuthenticationToken('RESPONSE: {}'.format(await response.text()))
+                        data = await response.json()
+                    self.accessToken = data["access_token"]
+                    self.expiresAt = time.time() + int(data.get("expires_in", 3600))
+                    logging.info("Access token is received")
+        return self.accessToken
+
+    async def request(self, method, url, headers=None, authenticate=True, deadline=None, invalidateCache=True,
+                      **kwargs):
+        """ Same retry policy as SharePointClient.request. Returns the unread response,
+        which the caller reads inside `async with response:` """
+        deadline = time.time() + (deadline or self.request_deadline)
+        attempt = 0
+        renewed = False
+        data = kwargs.get("data")
+        while True:
+            requestHeaders = dict(headers or {})
+            if authenticate:
+                usedToken = await self.getAccessToken()
+                requestHeaders["Authorization"] = "Bearer " + usedToken
+            if hasattr(data, 'seek'):
+                # aiohttp closes a file body once it is sent, a retry sends it again from a new handle
+                if data.closed:
+                    data = kwargs["data"] = open(data.name, 'rb')
+                data.seek(0)
+            try:
+                response = await self.session.request(method, url, headers=requestHeaders, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                status = None
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                logging.error('Connection Error: {}. Retrying in {:.1f} seconds.'.format(error, delay))
+            else:
+                if response.status < 400:
+                    return response
+                status = response.status
+                body = await response.text()
+                response.release()
+                if status == 401 and authenticate and not renewed:
+                    logging.error('Error status_code = 401. Renewing access token.')
+                    if usedToken == self.accessToken:
+                        self.expiresAt = 0
+                    renewed = True
+                    continue
+                if status not in RETRY_STATUS_CODES:
+                    if status == 404 and invalidateCache and url.startswith(self.baseUrl):
+                        self.cache.invalidate_url(url)
+                    raise get_exception_for_error_code(status)('RESPONSE: {}'.format(body))
+                delay = parse_retry_after(response.headers)
+                if delay is None:
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                logging.warning('Error status_code = {}. Retrying in {:.1f} seconds.'.format(status, delay))
+            attempt += 1
+            if attempt > self.max_retries or time.time() + delay > deadline:
+                if status is None:
+                    raise SharepointError("Connection to '{}' failed after {} attempts".format(url, attempt))
+                raise get_exception_for_error_code(status)('RESPONSE: {}'.format(body))
+            await asyncio.sleep(delay)
+
+    async def getJson(self, url, invalidateCache=True):
+        response = await self.request("GET", url, invalidateCache=invalidateCache)
+        async with response:
+            return await response.json()
+
+    async def iterPages(self, url):
+        """ Async iterator over values of a collection, following @odata.nextLink """
+        while url:
+            data = await self.getJson(url)
+            url = data.get("@odata.nextLink")
+            for value in data["value"]:
+                yield value
+
+    def iterSites(self, search=None):
+        url = self.baseUrl + "/sites?$select=siteCollection,webUrl,id,name"
+        if search:
+            url = url + "&search=" + quote(search)
+        return self.iterPages(url)
+
+    async def getSiteId(self, siteName, hostname=None):
+        cacheKey = "site:" + siteName
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return tuple(cached)
+
+        hostname = hostname or self.hostname
+        if hostname:
+            try:
+                url = self.baseUrl + "/sites/{}:/sites/{}?$select=id,name".format(hostname, siteName)
+                data = await self.getJson(url, invalidateCache=False)
+            except NotFound:
+                logging.info("Site '{}' is not found under '{}', searching for it".format(siteName, hostname))
+            else:
+                result = data["id"], hostname
+                self.cache.set(cacheKey, result)
+                return result
+
+        for search in (siteName, None):
+            async for value in self.iterSites(search=search):
+                if value.get("name") == siteName and "siteCollection" in value:
+                    result = value["id"], value["siteCollection"]["hostname"]
+                    self.cache.set(cacheKey, result)
+                    return result
+        raise Exception("Coundn't find specified '{}' site in sharepoint".format(siteName))
+
+    async def getSiteIdBySitePath(self, hostname, sitePath):
+        cacheKey = "sitePath:{}:/{}".format(hostname, sitePath)
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return tuple(cached)
+        data = await self.getJson(self.baseUrl + "/sites/{}:/{}".format(hostname, sitePath))
+        if "id" in data and "webUrl" in data:
+            result = data["id"], data["webUrl"]
+            self.cache.set(cacheKey, result)
+            return result
+        raise Exception("Coundn't get site id or web url for '{}' site".format(sitePath))
+
+    def iterDrives(self, siteId):
+        return self.iterPages(self.baseUrl + "/sites/" + siteId + "/drives")
+
+    async def getDrivesId(self, siteId, documentLibrary):
+        cacheKey = "drive:{}:{}".format(siteId, documentLibrary)
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return tuple(cached)
+        async for value in self.iterDrives(siteId):
+            if value.get("name") == documentLibrary:
+                result = value["id"], value["webUrl"]
+                self.cache.set(cacheKey, result)
+                return result
+        raise Exception("Coundn't find specified '{}' documentLibrary in sharepoint for site '{}'".format(
+            documentLibrary, siteId))
+
+    async def getDrivesIdByWebUrl(self, siteId, webUrl):
+        cacheKey = "driveWebUrl:{}:{}".format(siteId, webUrl)
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return cached
+        async for value in self.iterDrives(siteId):
+            if "webUrl" in value and webUrl == unquote(value["webUrl"]):
+                self.cache.set(cacheKey, value["id"])
+                return value["id"]
+        raise Exception("Coundn't find '{}' documentLibrary for site '{}'".format(webUrl, siteId))
+
+    def iterDriveItems(self, siteId, driveId, pageSize=None, folderId=None):
+        if folderId:
+            url = self.baseUrl + "/sites/" + siteId + "/drives/" + driveId + "/items/" + folderId + "/children"
+        else:
+            url = self.baseUrl + "/sites/" + siteId + "/drives/" + driveId + "/root/children"
+        pageSize = pageSize or self.page_size
+        if pageSize:
+            url = url + "?$top={}".format(pageSize)
+        return self.iterPages(url)
+
+    async def getFileAndFolderItems(self, siteId, driveId):
+        fileItemsInfo = []
+        folderItemsInfo = []
+        async for value in self.iterDriveItems(siteId, driveId):
+            if "file" in value:
+                fileItemsInfo.append(value)
+            elif "folder" in value:
+                folderItemsInfo.append(value)
+        return fileItemsInfo, folderItemsInfo
+
+    async def getLists(self, siteId):
+        return [value async for value in self.iterPages(self.baseUrl + "/sites/" + siteId + "/lists")]
+
+    async def getListId(self, siteId, listName):
+        cacheKey = "list:{}:{}".format(siteId, listName)
+        listId = self.cache.get(cacheKey)
+        if listId:
+            return listId
+        for listValue in await self.getLists(siteId):
+            if listValue["name"] == listName:
+                self.cache.set(cacheKey, listValue["id"])
+                return listValue["id"]
+        return None
+
+    async def getItems(self, siteId, listName):
+        listId = await self.getListId(siteId, listName)
+        if not listId:
+            raise Exception("Coundn't find specified list '{}' in site".format(listName))
+        url = self.baseUrl + "/sites/" + siteId + "/lists/" + listId + "/items?expand=fields"
+        return [item async for item in self.iterPages(url)]
+
+    async def download_file(self, url, filename=False, chunk_size=1024 * 1024):
+        local_filename = get_abs_path(filename)
+        try:
+            # download url is pre-authenticated
+            response = await self.request("GET", url, authenticate=False)
+            async with response:
+                with open(local_filename, 'wb') as fp:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        fp.write(chunk)
+            return True
+        except Exception as error:
+            logging.error("Exception has occured while downloading '{}': {}".format(local_filename, error))
+        return False
+
+    async def download_file_items(self, file_items_info, download_path):
+        """ Download all file items concurrently, bounded by max_connections.
+        Returns a dict of local file path -> True/False """
+        async def download(file_item_info):
+            file_path = download_path + '/' + file_item_info.get("relativePath", file_item_info["name"])
+            return file_path, await self.download_file(file_item_info["@microsoft.graph.downloadUrl"],
+                                                       filename=file_path)
+        return dict(await asyncio.gather(*(download(file_item_info) for file_item_info in file_items_info)))
+
+    async def upload_file(self, driveId, data, itemId = '', parentID = '', filename = ''):
+        if itemId:
+            url = self.baseUrl + "/drives/" + driveId + "/items/" + itemId + "/content"
+        elif parentID:
+            url = self.baseUrl + "/drives/" + driveId + "/items/" + parentID + ":/" + filename + ":/content"
+        else:
+            raise Exception("Could not find itemId or parentId for uploading file")
+        response = await self.request("PUT", url, headers={"Content-Type": "text/plain"}, data=data)
+        async with response:
+            return await response.json()
+
+    async def upload_local_file(self, driveId, file_path, itemId = '', parentID = '', filename = ''):
+        if os.path.getsize(file_path) > self.upload_session_threshold:
+            return await self.upload_large_file(driveId, file_path, itemId=itemId, parentID=parentID,
+                                                filename=filename)
+        # aiohttp streams the file object instead of holding the whole file in memory
+        with open(file_path, 'rb') as f:
+            return await self.upload_file(driveId, f, itemId=itemId, parentID=parentID, filename=filename)
+
+    async def upload_large_file(self, driveId, file_path, itemId = '', parentID = '', filename = ''):
+        if itemId:
+            url = self.baseUrl + "/drives/" + driveId + "/items/" + itemId + "/createUploadSession"
+        elif parentID:
+            url = self.baseUrl + "/drives/" + driveId + "/items/" + parentID + ":/" + filename + ":/createUploadSession"
+        else:
+            raise Exception("Could not find itemId or parentId for uploading file")
+        body = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+        response = await self.request("POST", url, json=body)
+        async with response:
+            uploadUrl = (await response.json())["uploadUrl"]
+
+        file_size = os.path.getsize(file_path)
+        offset = 0
+        result = {}
+        with map_file(file_path) as view:
+            while offset < file_size:
+                with view[offset:offset + self.upload_fragment_size] as chunk:
+                    chunk_length = chunk.nbytes
+                    headers = {"Content-Range": "bytes {}-{}/{}".format(offset, offset + chunk_length - 1, file_size)}
+                    # uploadUrl is pre-authenticated
+                    response = await self.request("PUT", uploadUrl, authenticate=False, headers=headers, data=chunk)
+                async with response:
+                    data = await response.json()
+                if response.status == 202:
+                    next_expected_ranges = data.get("nextExpectedRanges", [])
+                    offset = int(next_expected_ranges[0].split("-")[0]) if next_expected_ranges \
+                        else offset + chunk_length
+                else:
+                    result = data
+                    break
+        return result
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+import logging
+from urllib.parse import urlsplit, unquote
+from sharepoint_document_library.utils import load_json, save_state
+
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+# Path segments following these collections are the ids held by the cache
+ID_COLLECTIONS = ("sites", "drives", "lists")
+
+
+def get_url_ids(url):
+    """ Site, drive and list ids in the path of a Graph url. Addressing by path, like
+    /sites/{hostname}:/sites/{name}, holds no id """
+    ids = set()
+    segments = [unquote(segment) for segment in urlsplit(url).path.split("/")]
+    for collection, segment in zip(segments, segments[1:]):
+        if ":" in segment:
+            # the rest of the url is a path below this segment
+            break
+        if collection in ID_COLLECTIONS and segment:
+            ids.add(segment)
+    return ids
+
+
+def get_cache_scope(tenant_name, baseUrl):
+    """ Key prefix of the entries of one tenant and Graph endpoint """
+    return "{}|{}|".format(tenant_name, baseUrl)
+
+
+class ResolutionCache:
+    """ Cache of site, drive and list ids resolved by name or path. Entries expire after ttl
+    seconds and are persisted to a JSON file when path is given. Keys are prefixed with scope,
+    e.g. the tenant and endpoint, so clients of several tenants can share one file """
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, path=None, scope=''):
+        self.ttl = ttl
+        self.path = path
+        self.scope = scope
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                self.entries = load_json(path)
+            except ValueError:
+                logging.warning("Resolution cache '{}' is corrupted, starting with an empty cache".format(path))
+
+    def scoped(self, key):
+        return self.scope + key
+
+    def get(self, key):
+        key = self.scoped(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires"] < time.time():
+                del self.entries[key]
+                return None
+            return entry["value"]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[self.scoped(key)] = {"value": value, "expires": time.time() + self.ttl}
+            self.save()
+
+    def set_many(self, values):
+        with self.lock:
+            expires = time.time() + self.ttl
+            for key, value in values.items():
+                self.entries[self.scoped(key)] = {"value": value, "expires": expires}
+            self.save()
+
+    def invalidate(self, key=None):
+        """ Drop one entry, or every entry of the scope when key is None """
+        with self.lock:
+            if key is None:
+                self.entries = {name: entry for name, entry in self.entries.items() if not name.startswith(self.scope)}
+            else:
+                self.entries.pop(self.scoped(key), None)
+            self.save()
+
+    def invalidate_url(self, url):
+        """ Drop entries holding a site, drive or list id of url, called when url returned 404 """
+        ids = get_url_ids(url)
+        if not ids:
+            return
+        with self.lock:
+            stale_keys = [key for key, entry in self.entries.items() if key.startswith(self.scope)
+                          and any(isinstance(value, str) and value in ids for value in self.values(entry))]
+            for key in stale_keys:
+                logging.info("Resolution cache entry '{}' is invalidated".format(key))
+                del self.entries[key]
+            if stale_keys:
+                self.save()
+
+    def values(self, entry):
+        value = entry["value"]
+        return value if isinstance(value, (list, tuple)) else [value]
+
+    def save(self):
+        if self.path:
+            save_state(self.path, self.entries)
@@ -1,11 +1,30 @@
+import os
+import time
+import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-import tqdm
-from urllib.parse import unquote
-from sharepoint_document_library.utils import get_abs_path
+from urllib.parse import unquote, quote
+from sharepoint_document_library.utils import get_abs_path, map_file, get_state_file, load_state, save_state
+from sharepoint_document_library.cache import ResolutionCache, DEFAULT_CACHE_TTL, get_cache_scope
+from sharepoint_document_library.progress import get_progress, NoProgress
+from sharepoint_document_library.hashing import ContentHasher, hash_file, compare_hashes
+from sharepoint_document_library.metrics import Metrics, StatsdExporter, endpoint_template
+from sharepoint_document_library.tracing import get_tracer, NoTracer
+from sharepoint_document_library.token_cache import TokenCache, get_cache_key
 import logging
 
-logging.basicConfig(level = logging.INFO)
+# Graph accepts at most 4 MB in a single PUT to /content
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+# Upload session fragments must be a multiple of 320 KiB
+UPLOAD_FRAGMENT_MULTIPLE = 320 * 1024
+DEFAULT_UPLOAD_FRAGMENT_SIZE = 32 * UPLOAD_FRAGMENT_MULTIPLE
+# Files at least this big are downloaded as byte ranges over several connections
+DEFAULT_RANGE_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_RANGE_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_DOWNLOAD_BUFFER_SIZE = 1024 * 1024
 
 class SharepointError(Exception):
     pass
@@ -31,17 +50,41 @@ class Conflict(SharepointError):
     pass
 
 
+class PreconditionFailed(SharepointError):
+    pass
+
+
+class TooManyRequests(SharepointError):
+    pass
+
+
 class InternalServiceError(SharepointError):
     pass
 
 
+class ServiceUnavailable(SharepointError):
+    pass
+
+
+class CorruptedDownload(SharepointError):
+    pass
+
+
 ERROR_CODE_EXCEPTION_MAPPING = {
     400: BadRequest,
     401: InvalidAuthenticationToken,
     403: Forbidden,
     404: NotFound,
     409: Conflict,
-    500: InternalServiceError}
+    412: PreconditionFailed,
+    429: TooManyRequests,
+    500: InternalServiceError,
+    503: ServiceUnavailable}
+
+# Throttling and transient server errors, retried with backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Graph accepts at most 20 requests in one $batch
+BATCH_LIMIT = 20
 
 
 def get_exception_for_error_code(status_code):
@@ -65,383 +108,953 @@ def raise_for_error(response):
             raise SharepointError(error)
 
 
+def backoff_delay(attempt, base, maximum):
+    """ Exponential backoff with jitter, so throttled workers do not retry in lockstep """
+    return min(maximum, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def parse_retry_after(headers):
+    try:
+        return max(0.0, float(headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
+def raise_response_error(response):
+    """ Like raise_for_error, but also raises for error responses without a body """
+    raise_for_error(response)
+    raise get_exception_for_error_code(response.status_code)(
+        'RESPONSE: status code {}'.format(response.status_code))
+
+
+class TokenProvider:
+    """ Client credentials token shared by all threads using the client. The token is refreshed
+    refresh_margin seconds before it expires, and only one thread requests a new token at a time.
+    With tokenCache, a token cached by another process under cacheKey is reused while valid """
+    def __init__(self, session, tokenUrl, tokenData, refresh_margin=300, onRefresh=None, tokenCache=None,
+                 cacheKey=None):
+        self.session = session
+        self.onRefresh = onRefresh
+        self.tokenCache = tokenCache
+        self.cacheKey = cacheKey
+        self.tokenUrl = tokenUrl
+        self.tokenData = tokenData
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.accessToken = None
+        self.expiresAt = 0
+
+    def isValid(self):
+        return self.accessToken is not None and time.time() < self.expiresAt - self.refresh_margin
+
+    def getToken(self):
+        if not self.isValid():
+            with self.lock:
+                # another thread may have refreshed the token while this one was waiting for the lock
+                if not self.isValid():
+                    if self.tokenCache is None:
+                        self.fetchToken()
+                    else:
+                        self.getCachedToken()
+        return self.accessToken
+
+    def getCachedToken(self):
+        # the file lock makes other processes wait for this token instead of requesting their own
+        with self.tokenCache.lock():
+            cached = self.tokenCache.get(self.cacheKey, self.refresh_margin)
+            if cached is not None:
+                self.accessToken, self.expiresAt = cached
+                logging.info("Access token is reused from the token cache")
+                return
+            self.fetchToken()
+            self.tokenCache.set(self.cacheKey, self.accessToken, self.expiresAt)
+
+    def invalidate(self, usedToken=None):
+        """ Force a refresh, unless usedToken was already replaced by another thread """
+        with self.lock:
+            if usedToken is None or usedToken == self.accessToken:
+                self.expiresAt = 0
+                if self.tokenCache is not None:
+                    self.tokenCache.discard(self.cacheKey, usedToken)
+
+    def fetchToken(self):
+        started = time.perf_counter()
+        response = self.session.post(self.tokenUrl, data=self.tokenData)
+        if self.onRefresh is not None:
+            self.onRefresh({"type": "token_refresh", "status": response.status_code,
+                            "latency": time.perf_counter() - started})
+        if response.status_code != 200:
+            logging.error('Error status_code = {}'.format(response.status_code))
+            raise_for_error(response)
+            raise InvalidAuthenticationToken("Couldn't get access token, status code {}".format(response.status_code))
+        data = response.json()
+        self.accessToken = data["access_token"]
+        self.expiresAt = time.time() + int(data.get("expires_in", 3600))
+        logging.info("Access token is received")
+
+
+def request_body_size(kwargs):
+    data = kwargs.get("data")
+    if data is None:
+        return len(kwargs["json"]) if isinstance(kwargs.get("json"), (str, bytes)) else 0
+    if isinstance(data, memoryview):
+        return data.nbytes
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    if hasattr(data, 'fileno'):
+        return os.fstat(data.fileno()).st_size
+    return 0
+
+
+def response_body_size(response):
+    # streamed bodies are not read yet, their size is what the server announced
+    if response.raw is not None and not response._content_consumed:
+        return int(response.headers.get("Content-Length") or 0)
+    return len(response.content or b"")
+
+
+def merge_spans(spans):
+    """ Sorted [start, end) byte spans with overlapping and adjacent spans merged """
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_spans(spans, size):
+    """ [start, end) byte spans of a file of size bytes not covered by spans """
+    missing = []
+    position = 0
+    for start, end in merge_spans(spans):
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+
 class SharePointClient:
-    def __init__(self, config):
+    def __init__(self, config, cache=None, progress=None, hooks=None, tracer=None):
         self.tenant_name = config['tenant_name']
         self.client_id = config['client_id']
         self.client_secret = config['client_secret']
         self.grant_type = config['grant_type']
         self.scope = config['scope']
 
-        self.tokenUrl = "https://login.microsoftonline.com/{}/oauth2/v2.0/token".format(self.tenant_name)
+        # token_url and base_url point the client at another endpoint, e.g. the benchmark stand-in server
+        self.tokenUrl = config.get('token_url',
+                                   "https://login.microsoftonline.com/{}/oauth2/v2.0/token".format(self.tenant_name))
         self.tokenData = {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "grant_type": self.grant_type,
             "scope": self.scope
         }
-        self.baseUrl = "https://graph.microsoft.com/v1.0"
+        self.baseUrl = config.get('base_url', "https://graph.microsoft.com/v1.0")
+        self.max_workers = int(config.get('max_workers', 1))
+        self.page_size = config.get('page_size', None)
+        self.hostname = config.get('hostname', None)
+        self.max_retries = int(config.get('max_retries', 5))
+        self.request_deadline = float(config.get('request_deadline', 300))
+        self.backoff_base = float(config.get('backoff_base', 1))
+        self.backoff_max = float(config.get('backoff_max', 60))
+        if cache is None:
+            cache_path = get_state_file(config, "resolution_cache.json") if config.get('cache_on_disk') else None
+            cache = ResolutionCache(ttl=int(config.get('cache_ttl', DEFAULT_CACHE_TTL)), path=cache_path,
+                                    scope=get_cache_scope(self.tenant_name, self.baseUrl))
+        self.cache = cache
+        self.upload_session_threshold = int(config.get('upload_session_threshold', SIMPLE_UPLOAD_LIMIT))
+        fragment_size = int(config.get('upload_fragment_size', DEFAULT_UPLOAD_FRAGMENT_SIZE))
+        self.upload_fragment_size = max(UPLOAD_FRAGMENT_MULTIPLE,
+                                        fragment_size - fragment_size % UPLOAD_FRAGMENT_MULTIPLE)
+        self.range_connections = int(config.get('range_connections', 4))
+        self.range_download_threshold = int(config.get('range_download_threshold', DEFAULT_RANGE_DOWNLOAD_THRESHOLD))
+        self.range_part_size = int(config.get('range_part_size', DEFAULT_RANGE_PART_SIZE))
+        self.download_buffer_size = int(config.get('download_buffer_size', DEFAULT_DOWNLOAD_BUFFER_SIZE))
+        self.progress = get_progress(progress or config.get('progress', 'tqdm'))
+        self.verify_hashes = bool(config.get('verify_hashes', False))
+        self.hash_algorithms = tuple(config.get('hash_algorithms', ["quickXorHash"]))
         self.session = requests.Session()
-        self.accessToken = self.getAccessToken()
-        self.headers = {"content-type": "application/json", "Authorization": "Bearer " + self.accessToken}
+        # Crawl, download and range worker threads share this session, so the pool must hold a connection per worker
+        pool_size = max(10, 2 * self.max_workers, self.max_workers * self.range_connections)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # hooks are called with an event dict after every HTTP call and token refresh
+        self.metrics = Metrics()
+        self.hooks = [self.metrics] + list(hooks or [])
+        if config.get('statsd_address'):
+            self.hooks.append(StatsdExporter(config['statsd_address'], prefix=config.get('metrics_prefix', 'sharepoint')))
+        self.tracer = tracer or get_tracer(config)
+        if not isinstance(self.tracer, NoTracer):
+            self.hooks.append(self.tracer)
+        tokenCache = None
+        if config.get('token_cache'):
+            tokenCache = TokenCache(config.get('token_cache_path') or get_state_file(config, "token_cache.json"),
+                                    key=config.get('token_cache_key') or os.environ.get('SHAREPOINT_TOKEN_CACHE_KEY'))
+        self.tokenProvider = TokenProvider(self.session, self.tokenUrl, self.tokenData,
+                                           refresh_margin=int(config.get('token_refresh_margin', 300)),
+                                           onRefresh=self.emit, tokenCache=tokenCache,
+                                           cacheKey=get_cache_key(self.tenant_name, self.client_id, self.scope))
+        self.getAccessToken()
+
+    @property
+    def accessToken(self):
+        return self.tokenProvider.getToken()
+
+    @property
+    def headers(self):
+        return {"content-type": "application/json", "Authorization": "Bearer " + self.accessToken}
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.session.close()
+        self.tracer.save()
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def emit(self, event):
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as error:
+                logging.warning("Instrumentation hook {} failed: {}".format(hook, error))
+
+    def emitRequest(self, method, url, started, status, kwargs, response=None, retries=0, throttled=0,
+                    throttle_wait=0.0, headers=None):
+        headers = headers or {}
+        self.emit({
+            "type": "request",
+            "method": method,
+            "url": url,
+            "endpoint": endpoint_template(url, self.baseUrl),
+            "status": status,
+            "latency": time.perf_counter() - started,
+            "bytes_sent": request_body_size(kwargs),
+            "bytes_received": response_body_size(response) if response is not None else 0,
+            "retries": retries,
+            "throttled": throttled,
+            "throttle_wait": throttle_wait,
+            "range": headers.get("Range") or headers.get("Content-Range")
+        })
 
     def getAccessToken(self):
-        response = self.session.post(self.tokenUrl, data=self.tokenData)
-        if response.status_code != 200:
-            logging.error('Error status_code = {}'.format(response.status_code))
-            raise_for_error(response)
-        else:
-            self.accessToken = response.json()["access_token"]
-            self.headers = {"content-type": "application/json", "Authorization": "Bearer " + self.accessToken}
-            return self.accessToken
+        return self.tokenProvider.getToken()
+
+    def renewAccessToken(self, response=None):
+        """ Renew the token after a 401 response. Other failures are not caused by the token and leave it as is """
+        if response is not None and response.status_code != 401:
+            return
+        usedToken = None
+        if response is not None:
+            usedToken = response.request.headers.get("Authorization", "")[len("Bearer "):]
+        self.tokenProvider.invalidate(usedToken)
+
+    def backoff(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+    def retryAfter(self, response):
+        return parse_retry_after(response.headers)
+
+    def request(self, method, url, headers=None, authenticate=True, deadline=None, invalidateCache=True, **kwargs):
+        """ Send a request through the shared retry policy. A 401 renews the token once, connection
+        errors, 429 and 5xx responses are retried after Retry-After or an exponential backoff until
+        max_retries or the deadline runs out. Other errors raise the mapped SharepointError.
+        A 404 of a Graph url drops the cached ids it holds, unless invalidateCache is False
+        because the caller expects and handles it """
+        deadline = time.time() + (deadline or self.request_deadline)
+        started = time.perf_counter()
+        attempt = 0
+        throttled = 0
+        throttleWait = 0.0
+        renewed = False
+        data = kwargs.get("data")
+        while True:
+            requestHeaders = dict(headers or {})
+            if authenticate:
+                requestHeaders["Authorization"] = "Bearer " + self.accessToken
+            if hasattr(data, 'seek'):
+                # rewind file handle left partially sent by a failed attempt
+                data.seek(0)
+            try:
+                response = self.session.request(method, url, headers=requestHeaders, **kwargs)
+            except requests.RequestException as error:
+                response = None
+                delay = self.backoff(attempt)
+                logging.error('Connection Error: {}. Retrying in {:.1f} seconds.'.format(error, delay))
+            else:
+                if response.status_code < 400:
+                    self.emitRequest(method, url, started, response.status_code, kwargs, response, attempt,
+                                     throttled, throttleWait, headers)
+                    return response
+                if response.status_code == 401 and authenticate and not renewed:
+                    logging.error('Error status_code = 401. Renewing access token.')
+                    self.renewAccessToken(response)
+                    renewed = True
+                    continue
+                if response.status_code not in RETRY_STATUS_CODES:
+                    if response.status_code == 404 and invalidateCache and url.startswith(self.baseUrl):
+                        # a cached site, drive or list id may no longer exist
+                        self.cache.invalidate_url(url)
+                    self.emitRequest(method, url, started, response.status_code, kwargs, response, attempt,
+                                     throttled, throttleWait, headers)
+                    raise_response_error(response)
+                delay = self.retryAfter(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if response.status_code == 429:
+                    throttled += 1
+                    throttleWait += delay
+                logging.warning('Error status_code = {}. Retrying in {:.1f} seconds.'.format(
+                    response.status_code, delay))
+                response.close()
+            attempt += 1
+            if attempt > self.max_retries or time.time() + delay > deadline:
+                self.emitRequest(method, url, started, response.status_code if response is not None else None,
+                                 kwargs, response, attempt - 1, throttled, throttleWait, headers)
+                if response is None:
+                    raise SharepointError("Connection to '{}' failed after {} attempts".format(url, attempt))
+                raise_response_error(response)
+            time.sleep(delay)
+
+    def getJson(self, url, headers=None, invalidateCache=True):
+        return self.request("GET", url, headers=headers, invalidateCache=invalidateCache).json()
 
-    def renewAccessToken(self):
-        self.accessToken = self.getAccessToken()
-        self.headers = {"content-type": "application/json", "Authorization": "Bearer " + self.accessToken}
+    def iterPages(self, url, headers=None):
+        """ Yield values of a collection page by page, following @odata.nextLink """
+        while url:
+            data = self.getJson(url, headers=headers)
+            url = data.get("@odata.nextLink")
+            for value in data["value"]:
+                yield value
 
-    def getSiteId(self, siteName):
+    def iterSites(self, search=None):
+        """ Yield sites of the tenant page by page, optionally filtered server-side by a search query """
         url = self.baseUrl + "/sites?$select=siteCollection,webUrl,id,name"
-        success = False
-        retry = 1
-        while not success:
+        if search:
+            url = url + "&search=" + quote(search)
+        return self.iterPages(url)
+
+    def cacheSites(self, sites):
+        """ Index sites by name in the resolution cache, returns the name -> (id, hostname) index """
+        index = {}
+        for value in sites:
+            if "name" in value and "siteCollection" in value:
+                index[value["name"]] = (value["id"], value["siteCollection"]["hostname"])
+        self.cache.set_many({"site:" + name: result for name, result in index.items()})
+        return index
+
+    def getSiteId(self, siteName, hostname=None):
+        result = self.findSiteId(siteName, hostname)
+        if result:
+            return result
+        # search index may lag behind newly created sites, fall back to listing all of them
+        index = self.cacheSites(self.iterSites())
+        if siteName in index:
+            return index[siteName]
+        raise Exception("Coundn't find specified '{}' site in sharepoint".format(siteName))
+
+    def findSiteId(self, siteName, hostname=None):
+        """ (site id, hostname) from the cache, the hostname:path address or a site search, None when
+        none of them finds the site """
+        cacheKey = "site:" + siteName
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return tuple(cached)
+
+        hostname = hostname or self.hostname
+        if hostname:
+            # address the site directly by hostname:path, no listing needed
             try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
+                data = self.getJson(self.baseUrl + "/sites/{}:/sites/{}?$select=id,name".format(hostname, siteName),
+                                    invalidateCache=False)
+            except NotFound:
+                logging.info("Site '{}' is not found under '{}', searching for it".format(siteName, hostname))
             else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    retry += 1
-                    if retry > 4:
-                        raise_for_error(response)
-                else:
-                    success = True
-                    values = response.json()["value"]
-                    for value in values:
-                        if "name" in value:
-                            if siteName == value["name"]:
-                                return value["id"], value["siteCollection"]["hostname"]
+                result = data["id"], hostname
+                self.cache.set(cacheKey, result)
+                return result
+
+        for value in self.iterSites(search=siteName):
+            if value.get("name") == siteName:
+                result = value["id"], value["siteCollection"]["hostname"]
+                self.cache.set(cacheKey, result)
+                return result
+        return None
+
+    def getSiteIds(self, siteNames, hostname=None):
+        """ Resolve many site names like getSiteId, listing all sites a single time for the names
+        neither the hostname:path address nor the search finds """
+        result = {}
+        missing = []
+        for siteName in siteNames:
+            found = self.findSiteId(siteName, hostname)
+            if found:
+                result[siteName] = found
+            else:
+                missing.append(siteName)
+        if missing:
+            index = self.cacheSites(self.iterSites())
+            for siteName in missing:
+                if siteName not in index:
                     raise Exception("Coundn't find specified '{}' site in sharepoint".format(siteName))
+                result[siteName] = index[siteName]
+        return result
 
     def getSiteIdBySitePath(self, hostname, sitePath):
-        url = self.baseUrl + "/sites/{}:/{}".format(hostname, sitePath)
-        success = False
-        retry = 1
-        while not success:
-            try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    retry += 1
-                    if retry > 4:
-                        raise_for_error(response)
-                else:
-                    success = True
-                    data = response.json()
-                    if "id" in data and "webUrl" in data:
-                        return data["id"], data["webUrl"]
-                    raise Exception("Coundn't get site id or web url for '{}' site".format(sitePath))
+        cacheKey = "sitePath:{}:/{}".format(hostname, sitePath)
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return tuple(cached)
+        data = self.getJson(self.baseUrl + "/sites/{}:/{}".format(hostname, sitePath))
+        if "id" in data and "webUrl" in data:
+            result = data["id"], data["webUrl"]
+            self.cache.set(cacheKey, result)
+            return result
+        raise Exception("Coundn't get site id or web url for '{}' site".format(sitePath))
+
+    def iterDrives(self, siteId):
+        return self.iterPages(self.baseUrl + "/sites/" + siteId + "/drives")
 
     def getDrivesId(self, siteId, documentLibrary):
-        url = self.baseUrl + "/sites/" + siteId + "/drives"
-        success = False
-        retry = 1
-        while not success:
-            try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    retry += 1
-                    if retry > 4:
-                        raise_for_error(response)
-                else:
-                    success = True
-                    values = response.json()["value"]
-                    for value in values:
-                        if "name" in value:
-                            if documentLibrary == value["name"]:
-                                return value["id"], value["webUrl"]
-                    raise Exception("Coundn't find specified '{}' documentLibrary in sharepoint for site '{}'".format(
-                        documentLibrary, siteId))
+        cacheKey = "drive:{}:{}".format(siteId, documentLibrary)
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return tuple(cached)
+        for value in self.iterDrives(siteId):
+            if "name" in value:
+                if documentLibrary == value["name"]:
+                    result = value["id"], value["webUrl"]
+                    self.cache.set(cacheKey, result)
+                    return result
+        raise Exception("Coundn't find specified '{}' documentLibrary in sharepoint for site '{}'".format(
+            documentLibrary, siteId))
 
     def getDrivesIdByWebUrl(self, siteId, webUrl):
-        url = self.baseUrl + "/sites/" + siteId + "/drives"
-        success = False
-        retry = 1
-        while not success:
-            try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    retry += 1
-                    if retry > 4:
-                        raise_for_error(response)
-                else:
-                    success = True
-                    values = response.json()["value"]
-                    for value in values:
-                        if "webUrl" in value:
-                            if webUrl == unquote(value["webUrl"]):
-                                return value["id"]
-                    raise Exception("Coundn't find '{}' documentLibrary for site '{}'".format(webUrl, siteId))
+        cacheKey = "driveWebUrl:{}:{}".format(siteId, webUrl)
+        cached = self.cache.get(cacheKey)
+        if cached:
+            return cached
+        for value in self.iterDrives(siteId):
+            if "webUrl" in value:
+                if webUrl == unquote(value["webUrl"]):
+                    self.cache.set(cacheKey, value["id"])
+                    return value["id"]
+        raise Exception("Coundn't find '{}' documentLibrary for site '{}'".format(webUrl, siteId))
 
     def getDriveDownloadUrl(self, siteId, driveId, fileName, lastUpdatedDate=False):
-        url = self.baseUrl + "/sites/" + siteId + "/drives/" + driveId + "/root/children"
-        success = False
-        while not success:
-            try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    # raise_for_error(response)
-                else:
-                    success = True
-                    fileExist = False
-                    values = response.json()["value"]
-                    for value in values:
-                        if "name" in value:
-                            if fileName == value["name"]:
-                                fileExist = True
-                                if lastUpdatedDate:
-                                    if lastUpdatedDate < datetime.strptime(value["lastModifiedDateTime"],
-                                                                           "%Y-%m-%dT%H:%M:%SZ"):
-                                        driveDownloadUrl = value["@microsoft.graph.downloadUrl"]
-                                        return driveDownloadUrl
-                                else:
-                                    driveDownloadUrl = value["@microsoft.graph.downloadUrl"]
-                                    return driveDownloadUrl
-                    if not fileExist:
-                        raise Exception(
-                            "Coundn't find specified '{}' file for drive {} of site '{}' in sharepoint".format(fileName,
-                                                                                                               driveId,
-                                                                                                               siteId))
-                    return False
+        for value in self.iterDriveItems(siteId, driveId):
+            if "name" in value:
+                if fileName == value["name"]:
+                    if lastUpdatedDate:
+                        if lastUpdatedDate < datetime.strptime(value["lastModifiedDateTime"],
+                                                               "%Y-%m-%dT%H:%M:%SZ"):
+                            driveDownloadUrl = value["@microsoft.graph.downloadUrl"]
+                            return driveDownloadUrl
+                        return False
+                    else:
+                        driveDownloadUrl = value["@microsoft.graph.downloadUrl"]
+                        return driveDownloadUrl
+        raise Exception(
+            "Coundn't find specified '{}' file for drive {} of site '{}' in sharepoint".format(fileName,
+                                                                                               driveId,
+                                                                                               siteId))
 
     def getDriveDownloadUrlByPath(self, driveId, itemPath, lastUpdatedDate=False):
         url = self.baseUrl + "/drives/" + driveId + "/root:/{}".format(itemPath)
-        success = False
-        retry = 1
-        while not success:
-            try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
+        try:
+            # a missing file says nothing about the cached drive id
+            data = self.getJson(url, invalidateCache=False)
+        except NotFound:
+            raise Exception("Coundn't find '{}' file in sharepoint".format(itemPath))
+        return self.getDownloadUrlAndDetails(data, itemPath, lastUpdatedDate)
+
+    def getDownloadUrlAndDetails(self, data, itemPath, lastUpdatedDate=False):
+        fileExist = False
+        if "@microsoft.graph.downloadUrl" in data:
+            fileExist = True
+            if lastUpdatedDate:
+                if lastUpdatedDate < datetime.strptime(data["lastModifiedDateTime"], "%Y-%m-%dT%H:%M:%SZ"):
+                    driveDownloadUrl = data["@microsoft.graph.downloadUrl"]
+                    fileDetails = {
+                        "FileCreatedDate": data["createdDateTime"],
+                        "FileModifieDate": data["lastModifiedDateTime"],
+                        "FileCreatedBy": data["createdBy"]["user"]["displayName"],
+                        "FileModifiedBy": data["lastModifiedBy"]["user"]["displayName"]
+                    }
+                    return driveDownloadUrl, fileDetails
             else:
-                if response.status_code != 200:
-                    logging.error(
-                        "Error status_code = {}. Coundn't find '{}' file in sharepoint or another error. Trying to renew access token.".format(
-                            response.status_code, itemPath))
-                    self.renewAccessToken()
-                    retry += 1
-                    if retry > 4:
-                        raise_for_error(response)
-                else:
-                    success = True
-                    fileExist = False
-                    data = response.json()
-                    if "@microsoft.graph.downloadUrl" in data:
-                        fileExist = True
-                        if lastUpdatedDate:
-                            if lastUpdatedDate < datetime.strptime(data["lastModifiedDateTime"], "%Y-%m-%dT%H:%M:%SZ"):
-                                driveDownloadUrl = data["@microsoft.graph.downloadUrl"]
-                                fileDetails = {
-                                    "FileCreatedDate": data["createdDateTime"],
-                                    "FileModifieDate": data["lastModifiedDateTime"],
-                                    "FileCreatedBy": data["createdBy"]["user"]["displayName"],
-                                    "FileModifiedBy": data["lastModifiedBy"]["user"]["displayName"]
-                                }
-                                return driveDownloadUrl, fileDetails
-                        else:
-                            driveDownloadUrl = data["@microsoft.graph.downloadUrl"]
-                            fileDetails = {
-                                "FileCreatedDate": data["createdDateTime"],
-                                "FileModifiedDate": data["lastModifiedDateTime"],
-                                "FileCreatedBy": data["createdBy"]["user"]["displayName"],
-                                "FileModifiedBy": data["lastModifiedBy"]["user"]["displayName"]
-                            }
-                            return driveDownloadUrl, fileDetails
-                    if not fileExist:
-                        raise Exception("Coundn't find '{}' file in sharepoint".format(itemPath))
-                    return False
+                driveDownloadUrl = data["@microsoft.graph.downloadUrl"]
+                fileDetails = {
+                    "FileCreatedDate": data["createdDateTime"],
+                    "FileModifiedDate": data["lastModifiedDateTime"],
+                    "FileCreatedBy": data["createdBy"]["user"]["displayName"],
+                    "FileModifiedBy": data["lastModifiedBy"]["user"]["displayName"]
+                }
+                return driveDownloadUrl, fileDetails
+        if not fileExist:
+            raise Exception("Coundn't find '{}' file in sharepoint".format(itemPath))
+        return False
+
+    def batchGet(self, urls):
+        """ GET many urls (relative to baseUrl) through $batch, up to 20 per round trip.
+        Returns response bodies in the order of urls, with a SharepointError in place of
+        each failed sub-request. Throttled sub-requests are retried on their own """
+        results = [None] * len(urls)
+        for start in range(0, len(urls), BATCH_LIMIT):
+            pending = list(range(start, min(start + BATCH_LIMIT, len(urls))))
+            attempt = 0
+            while pending:
+                body = {"requests": [{"id": str(index), "method": "GET", "url": urls[index]} for index in pending]}
+                response = self.request("POST", self.baseUrl + "/$batch",
+                                        headers={"content-type": "application/json"}, json=body)
+                throttled = []
+                delay = 0
+                for subResponse in response.json()["responses"]:
+                    index = int(subResponse["id"])
+                    status = subResponse["status"]
+                    if status < 400:
+                        results[index] = subResponse.get("body", {})
+                    elif status in RETRY_STATUS_CODES and attempt < self.max_retries:
+                        throttled.append(index)
+                        try:
+                            retryAfter = float(subResponse.get("headers", {})["Retry-After"])
+                        except (KeyError, ValueError):
+                            retryAfter = self.backoff(attempt)
+                        delay = max(delay, retryAfter)
+                    else:
+                        results[index] = get_exception_for_error_code(status)(
+                            'RESPONSE: {}'.format(subResponse.get("body")))
+                pending = throttled
+                if pending:
+                    logging.warning("{} batched requests are throttled. Retrying in {:.1f} seconds.".format(
+                        len(pending), delay))
+                    time.sleep(delay)
+                    attempt += 1
+        return results
+
+    def getDriveItemsByPath(self, driveId, itemPaths):
+        """ Bulk metadata lookup, returns a dict of item path -> drive item (or the SharepointError raised) """
+        urls = ["/drives/" + driveId + "/root:/" + quote(itemPath) for itemPath in itemPaths]
+        return dict(zip(itemPaths, self.batchGet(urls)))
+
+    def getDriveItemsById(self, driveId, itemIds):
+        """ Bulk metadata lookup, returns a dict of item id -> drive item (or the SharepointError raised) """
+        urls = ["/drives/" + driveId + "/items/" + itemId for itemId in itemIds]
+        return dict(zip(itemIds, self.batchGet(urls)))
+
+    def getDriveDownloadUrlsByPath(self, driveId, itemPaths, lastUpdatedDate=False):
+        """ Bulk variant of getDriveDownloadUrlByPath, returns a dict of item path -> result,
+        with the exception in place of the result for files that could not be resolved """
+        results = {}
+        for itemPath, data in self.getDriveItemsByPath(driveId, itemPaths).items():
+            if isinstance(data, NotFound):
+                data = Exception("Coundn't find '{}' file in sharepoint".format(itemPath))
+            if isinstance(data, Exception):
+                results[itemPath] = data
+                continue
+            try:
+                results[itemPath] = self.getDownloadUrlAndDetails(data, itemPath, lastUpdatedDate)
+            except Exception as error:
+                results[itemPath] = error
+        return results
+
+    def iterDriveItems(self, siteId, driveId, pageSize=None, folderId=None):
+        """ Yield children of the drive root (or of folderId) as pages arrive, following @odata.nextLink """
+        if folderId:
+            url = self.baseUrl + "/sites/" + siteId + "/drives/" + driveId + "/items/" + folderId + "/children"
+        else:
+            url = self.baseUrl + "/sites/" + siteId + "/drives/" + driveId + "/root/children"
+        pageSize = pageSize or self.page_size
+        if pageSize:
+            url = url + "?$top={}".format(pageSize)
+        return self.iterPages(url)
+
+    def crawlDriveItems(self, siteId, driveId, max_workers=None):
+        """ Walk the folder tree breadth-first, listing sibling folders concurrently.
+        Yields file and folder items with 'relativePath' set to their path below the library root """
+        max_workers = max_workers or self.max_workers
+
+        def listFolder(folderId, folderPath):
+            return folderPath, list(self.iterDriveItems(siteId, driveId, folderId=folderId))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(self.tracer.bind(listFolder), None, '')}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folderPath, values = future.result()
+                    for value in values:
+                        relativePath = folderPath + "/" + value["name"] if folderPath else value["name"]
+                        value["relativePath"] = relativePath
+                        if "folder" in value and value["folder"].get("childCount", 1):
+                            pending.add(executor.submit(self.tracer.bind(listFolder), value["id"], relativePath))
+                        yield value
+
+    def iterDeltaPages(self, driveId, deltaLink=None):
+        """ Yield (items, deltaLink) for each page of drive changes since deltaLink.
+        Without deltaLink every item of the drive is returned. deltaLink is set on the last page only """
+        url = deltaLink or self.baseUrl + "/drives/" + driveId + "/root/delta"
+        while url:
+            data = self.getJson(url)
+            url = data.get("@odata.nextLink")
+            yield data["value"], data.get("@odata.deltaLink")
+
+    def getDriveRoot(self, driveId):
+        return self.getJson(self.baseUrl + "/drives/" + driveId + "/root")
+
+    def delete_item(self, driveId, itemId, eTag=None):
+        """ With eTag, the delete raises PreconditionFailed when the remote file changed since eTag """
+        # a missing item says nothing about the cached drive id
+        self.request("DELETE", self.baseUrl + "/drives/" + driveId + "/items/" + itemId,
+                     headers={"If-Match": eTag} if eTag else None, invalidateCache=False)
+
+    def getDriveItem(self, driveId, itemId):
+        return self.getJson(self.baseUrl + "/drives/" + driveId + "/items/" + itemId, invalidateCache=False)
 
     def getFileAndFolderItems(self, siteId, driveId, lastUpdatedDate=False):
-        url = self.baseUrl + "/sites/" + siteId + "/drives/" + driveId + "/root/children"
-        success = False
         fileItemsInfo = []
         folderItemsInfo = []
-        while not success:
-            try:
-                response = self.session.get(url, headers=self.headers)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    # raise_for_error(response)
-                else:
-                    success = True
-                    values = response.json()["value"]
-                    for value in values:
-                        if "file" in value:
-                            fileItemsInfo.append(value)
-                        elif "folder" in value:
-                            folderItemsInfo.append(value)
+        for value in self.iterDriveItems(siteId, driveId):
+            if "file" in value:
+                fileItemsInfo.append(value)
+            elif "folder" in value:
+                folderItemsInfo.append(value)
         return fileItemsInfo, folderItemsInfo
 
 
     def getLists(self, siteId):
         url = self.baseUrl + "/sites/" + siteId + "/lists"
-        success = False
-        while not success:
-            try:
-                response = self.session.get(url, headers={"content-type": "application/json",
-                                                          "Authorization": "Bearer " + self.accessToken})
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code != 200:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                    # raise_for_error(response)
-                else:
-                    success = True
-                    logging.info("Received lists")
-                    return response.json()["value"]
+        values = list(self.iterPages(url))
+        logging.info("Received lists")
+        return values
 
-    def getItems(self, siteId, listName):
-        listValues = self.getLists(siteId)
-        listId = None
-        for listValue in listValues:
+    def getListId(self, siteId, listName):
+        cacheKey = "list:{}:{}".format(siteId, listName)
+        listId = self.cache.get(cacheKey)
+        if listId:
+            return listId
+        for listValue in self.getLists(siteId):
             if listValue["name"] == listName:
-                listId = listValue["id"]
-                break
+                self.cache.set(cacheKey, listValue["id"])
+                return listValue["id"]
+        return None
 
-        if listId:
-            urlItems = self.baseUrl + "/sites/" + siteId + "/lists/" + listId + "/items?expand=fields"
-            success = False
-            totalItems = []
-            while not success:
-                try:
-                    resultItems = self.session.get(urlItems, headers={"content-type": "application/json",
-                                                                      "Authorization": "Bearer " + self.accessToken})
-                except:
-                    logging.error('Connection Error. Trying to reconnect.')
-                    self.renewAccessToken()
-                else:
-                    if resultItems.status_code != 200:
-                        logging.error(
-                            'Error status_code = {}. Trying to renew access token.'.format(resultItems.status_code))
-                        self.renewAccessToken()
-                        # raise_for_error(response)
-                    else:
-                        data = resultItems.json()
-                        if "@odata.nextLink" in data:
-                            urlItems = data["@odata.nextLink"]
-                            success = False
-                        else:
-                            success = True
-                        items = data["value"]
-                        totalItems = totalItems + items
-            return totalItems
-        else:
+    def getItems(self, siteId, listName):
+        return list(self.iterItems(siteId, listName))
+
+    def iterItems(self, siteId, listName, fields=None, pageSize=None, filter=None):
+        """ Yield list items as pages arrive. fields limits the expanded columns, filter is an
+        OData $filter on them, e.g. "fields/Status eq 'Open'" """
+        listId = self.getListId(siteId, listName)
+        if not listId:
             raise Exception("Coundn't find specified list '{}' in site".format(listName))
 
-    def download_file(self, url, filename=False, verbose=False, file_size=None):
-        """ Download file with progressbar """
+        expand = "fields(select={})".format(",".join(fields)) if fields else "fields"
+        urlItems = self.baseUrl + "/sites/" + siteId + "/lists/" + listId + "/items?expand=" + expand
+        pageSize = pageSize or self.page_size
+        if pageSize:
+            urlItems = urlItems + "&$top={}".format(pageSize)
+        headers = None
+        if filter:
+            urlItems = urlItems + "&$filter=" + quote(filter)
+            # Graph refuses filters on columns that are not indexed without this header
+            headers = {"Prefer": "HonorNonIndexedQueriesWarningMayFailRandomly"}
+        return self.iterPages(urlItems, headers=headers)
+
+    def download_file(self, url, filename=False, verbose=False, file_size=None, show_progress=True, eTag=None,
+                      resolveUrl=None, hashes=None, progress=None):
+        """ Download file with progressbar into a '.part' file renamed once it is complete.
+        An interrupted download resumes from the bytes already written, later in this run or,
+        when eTag is given, in the next run. resolveUrl returns a fresh download url once the
+        pre-authenticated one has expired. With verify_hashes, the content is checked against
+        hashes, the drive item hashes facet. progress is the sink of this download instead of the
+        client progress """
         local_filename = get_abs_path(filename)
-        success = False
-        while not success:
+        part_filename = local_filename + '.part'
+        state_filename = part_filename + '.json'
+        progress = progress or (self.progress if show_progress else NoProgress())
+        started = time.time()
+        transferred = 0
+        attempt = 0
+        while True:
             try:
-                r = self.session.get(url, stream=True)
-                if r.status_code != 200:
-                    success = False
-                    logging.info("Response status code is not 200 while downloading the file, trying again")
-
-                elif r.status_code == 200:
-                    if not file_size:
-                        file_size = int(r.headers['Content-Length'])
-                    chunk = 1
-                    chunk_size = 1024
-                    num_bars = int(file_size / chunk_size)
-                    if verbose:
-                        logging.info(dict(file_size=file_size))
-                        logging.info(dict(num_bars=num_bars))
-
-                    with open(local_filename, 'wb') as fp:
-                        for chunk in tqdm.tqdm(
-                                r.iter_content(chunk_size=chunk_size)
-                                , total=num_bars
-                                , unit='KB'
-                                , desc=local_filename
-                                , leave=True  # progressbar stays
-                        ):
-                            fp.write(chunk)
-                    success = True
-                    return True
-            except:
-                success = True
-                logging.info("Exception has occured while downloading the file, trying again")
-        return False
+                ranged = bool(file_size) and self.range_connections > 1 and file_size >= self.range_download_threshold
+                state = self.load_part_state(part_filename, state_filename, file_size, eTag,
+                                             "ranges" if ranged else "stream", resume=attempt > 0 or eTag is not None)
+                if state["mode"] == "ranges":
+                    written = self.download_file_ranges(url, part_filename, file_size, state, state_filename,
+                                                        progress=progress)
+                    if written is None:
+                        # server ignores Range requests, start over as a single stream
+                        state = self.load_part_state(part_filename, state_filename, file_size, eTag, "stream",
+                                                     resume=False)
+                    else:
+                        transferred += written
+                hasher = None
+                if self.verify_hashes and hashes:
+                    # only a download written in one pass from the first byte can be hashed while streaming
+                    if state["mode"] == "stream" and not os.path.getsize(part_filename):
+                        hasher = ContentHasher(self.hash_algorithms)
+                if state["mode"] == "stream":
+                    transferred += self.download_stream(url, part_filename, file_size, verbose=verbose,
+                                                        progress=progress, hasher=hasher)
+                if self.verify_hashes and hashes:
+                    self.check_download_hashes(part_filename, state_filename, hashes, hasher)
+                os.replace(part_filename, local_filename)
+                os.remove(state_filename)
+                elapsed = max(time.time() - started, 1e-6)
+                logging.info("'{}' {:.1f} MB received in {:.1f} s, {:.1f} MB/s".format(
+                    local_filename, transferred / 1e6, elapsed, transferred / 1e6 / elapsed))
+                return True
+            except CorruptedDownload as error:
+                if attempt >= self.max_retries:
+                    logging.error(str(error))
+                    return False
+                logging.warning("{}. Downloading it again.".format(error))
+            except (InvalidAuthenticationToken, Forbidden) as error:
+                # pre-authenticated download urls expire after a while
+                if resolveUrl is None or attempt >= self.max_retries:
+                    logging.error("Download url of '{}' is no longer valid: {}".format(local_filename, error))
+                    return False
+                logging.info("Download url of '{}' has expired, resolving it again".format(local_filename))
+                url = resolveUrl()
+            except Exception as error:
+                if attempt >= self.max_retries:
+                    logging.error("Exception has occured while downloading '{}': {}".format(local_filename, error))
+                    return False
+                logging.warning("Exception has occured while downloading '{}': {}. Resuming download.".format(
+                    local_filename, error))
+                time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def load_part_state(self, part_filename, state_filename, file_size, eTag, mode, resume=True):
+        """ Progress of a partial download, reset when it belongs to another version of the file.
+        ranges holds the [start, end) byte spans already written by a ranged download """
+        state = load_state(state_filename, None) if resume else None
+        if state is None or not os.path.exists(part_filename) or state.get("size") != file_size \
+                or state.get("eTag") != eTag or state.get("mode") != mode \
+                or not all(isinstance(span, list) and len(span) == 2 for span in state.get("ranges", [])):
+            state = {"size": file_size, "eTag": eTag, "mode": mode, "ranges": []}
+            open(part_filename, 'wb').close()
+            save_state(state_filename, state)
+        return state
+
+    def check_download_hashes(self, part_filename, state_filename, hashes, hasher=None):
+        local_hashes = hasher.hexdigests() if hasher else hash_file(part_filename, self.hash_algorithms,
+                                                                    self.download_buffer_size)
+        if compare_hashes(local_hashes, {"file": {"hashes": hashes}}) is False:
+            # start over instead of resuming from corrupted content
+            os.remove(part_filename)
+            os.remove(state_filename)
+            raise CorruptedDownload("'{}' content does not match the hashes of the drive item: {} != {}".format(
+                part_filename, local_hashes, hashes))
+
+    def copy_stream(self, r, fp, progress, buffer, hasher=None):
+        """ Copy response body to fp through a reusable buffer instead of a new bytes object per chunk.
+        urllib3 2 readinto reads a new bytes object and copies it, so a body without Content-Encoding
+        is read into buffer by the underlying http.client response. Returns the number of bytes written """
+        fp_readinto = getattr(getattr(r.raw, "_fp", None), "readinto", None)
+        if fp_readinto is not None and r.headers.get("Content-Encoding", "identity") == "identity":
+            readinto = fp_readinto
+        else:
+            r.raw.decode_content = True
+            readinto = r.raw.readinto
+        view = memoryview(buffer)
+        written = 0
+        while True:
+            n = readinto(view)
+            if not n:
+                break
+            fp.write(view[:n])
+            if hasher is not None:
+                hasher.update(view[:n])
+            written += n
+            progress.update(n)
+        return written
+
+    def download_stream(self, url, part_filename, file_size, verbose=False, progress=None, hasher=None):
+        """ Stream file into part_filename over one connection, continuing after the bytes already in it.
+        Returns the number of bytes received """
+        progress = progress or self.progress
+        offset = os.path.getsize(part_filename)
+        if file_size and offset >= file_size:
+            return 0
+        # download url is pre-authenticated
+        r = self.request("GET", url, authenticate=False, stream=True,
+                         headers={"Range": "bytes={}-".format(offset)} if offset else None)
+        with r:
+            if offset and r.status_code != 206:
+                logging.info("Range requests are not supported for '{}', downloading it again".format(part_filename))
+                offset = 0
+            if not file_size:
+                file_size = offset + int(r.headers['Content-Length'])
+            if verbose:
+                logging.info(dict(file_size=file_size, offset=offset, buffer_size=self.download_buffer_size))
 
-    def upload_file(self, driveId, data, itemId = '', parentID = '', filename = ''):
+            task = progress.start(part_filename, file_size, initial=offset)
+            try:
+                with open(part_filename, 'ab' if offset else 'wb') as fp:
+                    written = self.copy_stream(r, fp, task, bytearray(self.download_buffer_size),
+                                               hasher=hasher if not offset else None)
+            finally:
+                task.close()
+        if os.path.getsize(part_filename) != file_size:
+            raise SharepointError("'{}' is incomplete: {} of {} bytes received".format(
+                part_filename, os.path.getsize(part_filename), file_size))
+        return written
+
+    def download_file_ranges(self, url, part_filename, file_size, state, state_filename, progress=None):
+        """ Download file as byte ranges fetched concurrently, each written at its offset of a
+        preallocated file. Completed byte spans are saved to state_filename so they are not fetched
+        again after an interruption, whatever range_part_size the next attempt uses. Returns the
+        number of bytes received, or None when the server ignores Range requests """
+        progress = progress or self.progress
+        missing = missing_spans(state["ranges"], file_size)
+        ranges = [(start, min(start + self.range_part_size, end) - 1)
+                  for spanStart, end in missing
+                  for start in range(spanStart, end, self.range_part_size)]
+        if os.path.getsize(part_filename) != file_size:
+            with open(part_filename, 'r+b') as fp:
+                fp.truncate(file_size)
+        stateLock = threading.Lock()
+        task = progress.start(part_filename, file_size,
+                              initial=file_size - sum(end - start + 1 for start, end in ranges))
+
+        def downloadRange(start, end):
+            r = self.request("GET", url, authenticate=False, stream=True,
+                             headers={"Range": "bytes={}-{}".format(start, end)})
+            with r:
+                if r.status_code != 206:
+                    return None
+                with open(part_filename, 'r+b') as fp:
+                    fp.seek(start)
+                    written = self.copy_stream(r, fp, task, bytearray(self.download_buffer_size))
+            if written != end - start + 1:
+                raise SharepointError("Range {}-{} of '{}' is incomplete: {} bytes received".format(
+                    start, end, part_filename, written))
+            with stateLock:
+                state["ranges"] = merge_spans(state["ranges"] + [[start, end + 1]])
+                save_state(state_filename, state)
+            return written
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.range_connections) as executor:
+                written = list(executor.map(self.tracer.bind(lambda byteRange: downloadRange(*byteRange)), ranges))
+        finally:
+            task.close()
+        if None in written:
+            logging.info("Range requests are not supported for '{}', downloading it in one stream".format(
+                part_filename))
+            return None
+        if missing_spans(state["ranges"], file_size):
+            raise SharepointError("'{}' is incomplete: byte spans {} are missing".format(
+                part_filename, missing_spans(state["ranges"], file_size)))
+        if os.path.getsize(part_filename) != file_size:
+            raise SharepointError("'{}' size does not match the expected {} bytes".format(part_filename, file_size))
+        return sum(written)
+
+    def upload_file(self, driveId, data, itemId = '', parentID = '', filename = '', eTag=None):
+        """ With eTag, the upload raises PreconditionFailed when the remote file changed since eTag """
         if itemId:
             url = self.baseUrl + "/drives/" + driveId + "/items/" + itemId + "/content"
         elif parentID:
             url = self.baseUrl + "/drives/" + driveId + "/items/" + parentID + ":/" + filename + ":/content"
         else:
             raise Exception("Could not find itemId or parentId for uploading file")
-        success = False
-        retry = 1
-        result = {}
-        while not success:
-            try:
-                response = self.session.put(url,
-                        headers={"Content-Type": "text/plain", "Authorization": "Bearer " + self.accessToken},
-                        data=data)
-            except:
-                logging.error('Connection Error. Trying to reconnect.')
-                self.renewAccessToken()
-            else:
-                if response.status_code == 401:
-                    logging.error('Error status_code = {}. Trying to renew access token.'.format(response.status_code))
-                    self.renewAccessToken()
-                elif response.status_code == 200 or response.status_code == 201:
-                    success = True
-                    result = response.json()
+        headers = {"Content-Type": "text/plain"}
+        if eTag:
+            headers["If-Match"] = eTag
+        # a missing item or folder says nothing about the cached drive id
+        response = self.request("PUT", url, headers=headers, data=data, invalidateCache=False)
+        return response.json()
+
+    def upload_local_file(self, driveId, file_path, itemId = '', parentID = '', filename = '', eTag=None):
+        """ Upload a local file, routing files above the threshold through an upload session """
+        if os.path.getsize(file_path) > self.upload_session_threshold:
+            return self.upload_large_file(driveId, file_path, itemId=itemId, parentID=parentID, filename=filename,
+                                          eTag=eTag)
+        # The file handle is streamed by requests instead of being read into memory
+        with open(file_path, 'rb') as f:
+            return self.upload_file(driveId, f, itemId=itemId, parentID=parentID, filename=filename, eTag=eTag)
+
+    def createUploadSession(self, driveId, itemId = '', parentID = '', filename = '', eTag=None):
+        if itemId:
+            url = self.baseUrl + "/drives/" + driveId + "/items/" + itemId + "/createUploadSession"
+        elif parentID:
+            url = self.baseUrl + "/drives/" + driveId + "/items/" + parentID + ":/" + filename + ":/createUploadSession"
+        else:
+            raise Exception("Could not find itemId or parentId for uploading file")
+        body = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+        headers = {"content-type": "application/json"}
+        if eTag:
+            headers["If-Match"] = eTag
+        response = self.request("POST", url, headers=headers, json=body, invalidateCache=False)
+        return response.json()["uploadUrl"]
+
+    def getUploadSessionOffset(self, uploadUrl):
+        """ Return the first byte the upload session still expects """
+        # uploadUrl is pre-authenticated, Graph rejects it when an Authorization header is sent
+        response = self.request("GET", uploadUrl, authenticate=False)
+        next_expected_ranges = response.json().get("nextExpectedRanges", [])
+        if not next_expected_ranges:
+            return None
+        return int(next_expected_ranges[0].split("-")[0])
+
+    def upload_large_file(self, driveId, file_path, itemId = '', parentID = '', filename = '', fragment_size=None,
+                          eTag=None):
+        """ Upload file in fragments through an upload session, resuming from the
+        last acknowledged byte after a connection drop. Returns the uploaded drive item """
+        fragment_size = fragment_size or self.upload_fragment_size
+        file_size = os.path.getsize(file_path)
+        uploadUrl = self.createUploadSession(driveId, itemId=itemId, parentID=parentID, filename=filename, eTag=eTag)
+        offset = 0
+        retry = 0
+        with map_file(file_path) as view:
+            while offset < file_size:
+                # fragments are slices of the mapped file, released as soon as they are sent
+                with view[offset:offset + fragment_size] as chunk:
+                    chunk_length = chunk.nbytes
+                    headers = {"Content-Length": str(chunk_length),
+                               "Content-Range": "bytes {}-{}/{}".format(offset, offset + chunk_length - 1, file_size)}
+                    try:
+                        response = self.request("PUT", uploadUrl, authenticate=False, headers=headers, data=chunk)
+                    except NotFound:
+                        # upload session expired
+                        raise
+                    except SharepointError as error:
+                        logging.error('Error while uploading fragment: {}. Resuming upload session.'.format(error))
+                        response = None
+                if response is None:
+                    retry += 1
+                    if retry > self.max_retries:
+                        raise SharepointError("Upload of '{}' failed after repeated errors".format(file_path))
+                    offset = self.getUploadSessionOffset(uploadUrl)
+                    if offset is None:
+                        # every byte was received, only the response to the last fragment was lost
+                        break
+                    continue
+                if response.status_code == 202:
+                    next_expected_ranges = response.json().get("nextExpectedRanges", [])
+                    offset = int(next_expected_ranges[0].split("-")[0]) if next_expected_ranges \
+                        else offset + chunk_length
+                    logging.info("'{}' uploaded {} of {} bytes".format(file_path, offset, file_size))
                 else:
-                    logging.error('Error status_code = {}.'.format(response.status_code))
-                    # self.renewAccessToken()
-                    raise_for_error(response)
-        return result
\ No newline at end of file
+                    # 200 or 201 with the drive item, once the last fragment is received
+                    return response.json()
+        logging.info("'{}' upload session is complete, fetching the uploaded item".format(file_path))
+        return self.getUploadedItem(driveId, itemId=itemId, parentID=parentID, filename=filename)
+
+    def getUploadedItem(self, driveId, itemId='', parentID='', filename=''):
+        """ Drive item replaced by itemId, or created as filename under parentID """
+        if itemId:
+            return self.getDriveItem(driveId, itemId)
+        return self.getJson(self.baseUrl + "/drives/" + driveId + "/items/" + parentID + ":/" + quote(filename) + ":",
+                            invalidateCache=False)
@@ -0,0 +1,46 @@
+import csv
+import json
+import logging
+
+
+def get_fields(item):
+    fields = dict(item.get("fields", {}))
+    fields.pop("@odata.etag", None)
+    return fields
+
+
+def write_ndjson(items, path):
+    """ Write the fields of each list item as one JSON line, as items arrive. Returns the number of rows """
+    count = 0
+    with open(path, 'w') as fil:
+        for item in items:
+            fil.write(json.dumps(get_fields(item)))
+            fil.write('\n')
+            count += 1
+    return count
+
+
+def write_csv(items, path, fields=None):
+    """ Write the fields of each list item as a CSV row, as items arrive. Columns are fields,
+    or the columns of the first item when fields is not given. Returns the number of rows """
+    count = 0
+    with open(path, 'w', newline='') as fil:
+        writer = None
+        for item in items:
+            row = get_fields(item)
+            if writer is None:
+                writer = csv.DictWriter(fil, fieldnames=fields or list(row), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def export_items(items, path, fields=None):
+    """ Stream items to path, as CSV when it ends with .csv and NDJSON otherwise """
+    if path.endswith('.csv'):
+        count = write_csv(items, path, fields)
+    else:
+        count = write_ndjson(items, path)
+    logging.info("{} list items are written to '{}'".format(count, path))
+    return count
@@ -0,0 +1,107 @@
+import base64
+import hashlib
+
+QUICK_XOR_WIDTH = 160
+QUICK_XOR_SHIFT = 11
+# byte i is xored in at bit (i * 11) % 160, so bit positions repeat every 160 bytes
+QUICK_XOR_PERIOD = 160
+QUICK_XOR_MASK = (1 << QUICK_XOR_WIDTH) - 1
+
+
+class QuickXorHash:
+    """ SharePoint / OneDrive for Business quickXorHash, computed incrementally.
+    Bytes that share a position modulo 160 land on the same bits, so each update xors
+    the whole chunk in as one big integer, aligned to its position modulo 160, instead
+    of looping over bytes """
+    name = "quickXorHash"
+
+    def __init__(self):
+        self.length = 0
+        self.folded = 0
+
+    def update(self, data):
+        offset = self.length % QUICK_XOR_PERIOD
+        self.folded ^= int.from_bytes(data, 'little') << (8 * offset)
+        self.length += len(data)
+
+    def digest(self):
+        period_bits = 8 * QUICK_XOR_PERIOD
+        # fold everything down to one 160-byte period, halving the number of periods each step
+        folded = self.folded
+        while folded.bit_length() > period_bits:
+            periods = -(-folded.bit_length() // period_bits)
+            half_bits = (periods // 2) * period_bits
+            folded = (folded & ((1 << half_bits) - 1)) ^ (folded >> half_bits)
+        state = 0
+        for position, byte in enumerate(folded.to_bytes(QUICK_XOR_PERIOD, 'little')):
+            if byte:
+                value = byte << (position * QUICK_XOR_SHIFT) % QUICK_XOR_WIDTH
+                state ^= (value & QUICK_XOR_MASK) | (value >> QUICK_XOR_WIDTH)
+        state ^= self.length << (QUICK_XOR_WIDTH - 64)
+        return state.to_bytes(QUICK_XOR_WIDTH // 8, 'little')
+
+    def hexdigest(self):
+        return base64.b64encode(self.digest()).decode()
+
+
+class HashlibHash:
+    """ hashlib algorithm reported the way the drive item hashes facet does, as uppercase hex """
+    def __init__(self, name, algorithm):
+        self.name = name
+        self.hash = hashlib.new(algorithm)
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest().upper()
+
+
+HASH_ALGORITHMS = {
+    "quickXorHash": QuickXorHash,
+    "sha1Hash": lambda: HashlibHash("sha1Hash", "sha1"),
+    "sha256Hash": lambda: HashlibHash("sha256Hash", "sha256")
+}
+
+
+class ContentHasher:
+    """ Computes several drive item hashes in one pass over the content """
+    def __init__(self, algorithms=("quickXorHash",)):
+        self.hashes = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
+
+    def update(self, data):
+        for content_hash in self.hashes:
+            content_hash.update(data)
+
+    def hexdigests(self):
+        return {content_hash.name: content_hash.hexdigest() for content_hash in self.hashes}
+
+
+def hash_file(file_path, algorithms=("quickXorHash",), buffer_size=1024 * 1024):
+    hasher = ContentHasher(algorithms)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb') as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigests()
+
+
+def compare_hashes(local_hashes, item_info):
+    """ True when every hash known on both sides matches, False on any mismatch,
+    None when the drive item has none of the computed hashes """
+    remote_hashes = item_info.get("file", {}).get("hashes", {})
+    compared = False
+    for name, value in local_hashes.items():
+        remote_value = remote_hashes.get(name)
+        if remote_value:
+            # quickXorHash is base64 and case sensitive, the sha hashes are hex
+            if name != "quickXorHash":
+                remote_value, value = remote_value.upper(), value.upper()
+            if remote_value != value:
+                return False
+            compared = True
+    return True if compared else None
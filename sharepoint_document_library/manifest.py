@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import threading
+import logging
+
+COLUMNS = ["drive_id", "relative_path", "item_id", "etag", "ctag", "size", "last_modified",
+           "local_mtime_ns", "local_size"]
+
+
+class SyncManifest:
+    """ Persistent SQLite record of transferred files, keyed by drive id and relative path.
+    Writes are buffered and committed in batches of batch_size rows """
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "drive_id TEXT NOT NULL, relative_path TEXT NOT NULL, item_id TEXT, etag TEXT, ctag TEXT, "
+            "size INTEGER, last_modified TEXT, local_mtime_ns INTEGER, local_size INTEGER, "
+            "PRIMARY KEY (drive_id, relative_path))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS items_item_id ON items (drive_id, item_id)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            rows = [row for row in self.pending.values() if row is not None]
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO items ({}) VALUES ({})".format(
+                    ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                [tuple(row[column] for column in COLUMNS) for row in rows])
+            for key, row in self.pending.items():
+                if row is None:
+                    self.connection.execute("DELETE FROM items WHERE drive_id = ? AND relative_path = ?", key)
+            self.connection.commit()
+            self.pending = {}
+        logging.info("Manifest '{}' is updated with {} rows".format(self.path, len(rows)))
+
+    def get(self, drive_id, relative_path):
+        with self.lock:
+            if (drive_id, relative_path) in self.pending:
+                return self.pending[(drive_id, relative_path)]
+            cursor = self.connection.execute(
+                "SELECT {} FROM items WHERE drive_id = ? AND relative_path = ?".format(", ".join(COLUMNS)),
+                (drive_id, relative_path))
+            row = cursor.fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def record(self, drive_id, relative_path, item_info, local_path):
+        """ Remember the remote item and local file state after a successful transfer """
+        stat = os.stat(local_path)
+        row = {
+            "drive_id": drive_id,
+            "relative_path": relative_path,
+            "item_id": item_info.get("id"),
+            "etag": item_info.get("eTag"),
+            "ctag": item_info.get("cTag"),
+            "size": item_info.get("size"),
+            "last_modified": item_info.get("lastModifiedDateTime"),
+            "local_mtime_ns": stat.st_mtime_ns,
+            "local_size": stat.st_size
+        }
+        with self.lock:
+            self.pending[(drive_id, relative_path)] = row
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def remove(self, drive_id, relative_path):
+        with self.lock:
+            self.pending[(drive_id, relative_path)] = None
+
+    def is_local_unchanged(self, row, local_path):
+        if not os.path.exists(local_path):
+            return False
+        stat = os.stat(local_path)
+        return row["local_mtime_ns"] == stat.st_mtime_ns and row["local_size"] == stat.st_size
+
+    def is_download_current(self, drive_id, relative_path, item_info, local_path):
+        """ True when the remote eTag is the one downloaded last time and the local copy is untouched """
+        row = self.get(drive_id, relative_path)
+        return bool(row) and row["etag"] == item_info.get("eTag") and self.is_local_unchanged(row, local_path)
+
+    def is_upload_current(self, drive_id, relative_path, local_path, item_info=None):
+        """ True when the local file is unchanged since it was uploaded and the remote copy was not replaced """
+        row = self.get(drive_id, relative_path)
+        return bool(row) and item_info is not None and row["etag"] == item_info.get("eTag") \
+            and self.is_local_unchanged(row, local_path)
@@ -0,0 +1,199 @@
+import os
+import re
+import time
+import socket
+import logging
+import threading
+from collections import defaultdict, Counter
+
+# Path segments following these collections are ids, replaced by placeholders in endpoint templates
+ID_SEGMENTS = {
+    "sites": "{siteId}",
+    "drives": "{driveId}",
+    "items": "{itemId}",
+    "lists": "{listId}"
+}
+# Prometheus quantile label and the summary key holding it
+QUANTILES = (("0.5", "p50"), ("0.95", "p95"))
+
+
+def endpoint_template(url, baseUrl):
+    """ Endpoint of url without ids, paths and query, e.g. /sites/{siteId}/drives/{driveId}/root/children,
+    so requests can be aggregated per endpoint. Pre-authenticated download and upload session urls
+    are reported as 'download' and 'uploadSession' """
+    path = url.split("?", 1)[0]
+    if not path.startswith(baseUrl):
+        return "uploadSession" if "upload" in path.lower() else "download"
+    path = re.sub(r":/[^:]*:?", ":/{path}:", path[len(baseUrl):])
+    segments = path.split("/")
+    for index in range(1, len(segments)):
+        placeholder = ID_SEGMENTS.get(segments[index - 1])
+        if placeholder and segments[index] and not segments[index].startswith("{"):
+            segments[index] = placeholder + (":" if ":" in segments[index] else "")
+    return "/".join(segments).rstrip(":") or "/"
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of already sorted values """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+class Metrics:
+    """ Client hook aggregating request events per endpoint: counts by status, latencies, bytes,
+    retries and throttle waits, plus token refreshes. Exported as a run summary or Prometheus text """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = Counter()
+        self.latencies = defaultdict(list)
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self.retries = Counter()
+        self.throttled = Counter()
+        self.throttle_wait = Counter()
+        self.token_refreshes = 0
+        self.token_latency = 0.0
+
+    def __call__(self, event):
+        with self.lock:
+            if event["type"] == "token_refresh":
+                self.token_refreshes += 1
+                self.token_latency += event["latency"]
+                return
+            if event["type"] != "request":
+                return
+            endpoint = event["endpoint"]
+            self.requests[(event["method"], endpoint, event["status"])] += 1
+            self.latencies[endpoint].append(event["latency"])
+            self.bytes_sent[endpoint] += event["bytes_sent"]
+            self.bytes_received[endpoint] += event["bytes_received"]
+            self.retries[endpoint] += event["retries"]
+            self.throttled[endpoint] += event["throttled"]
+            self.throttle_wait[endpoint] += event["throttle_wait"]
+
+    def summary(self):
+        """ p50/p95 latency, bytes, retries and throttling per endpoint, and totals of the run """
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            endpoints = {}
+            for endpoint, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                endpoints[endpoint] = {
+                    "requests": len(latencies),
+                    "p50": percentile(latencies, 0.5),
+                    "p95": percentile(latencies, 0.95),
+                    "bytes_sent": self.bytes_sent[endpoint],
+                    "bytes_received": self.bytes_received[endpoint],
+                    "retries": self.retries[endpoint],
+                    "throttled": self.throttled[endpoint],
+                    "throttle_wait": self.throttle_wait[endpoint]
+                }
+            total_bytes = sum(self.bytes_sent.values()) + sum(self.bytes_received.values())
+            return {
+                "elapsed": elapsed,
+                "requests": sum(self.requests.values()),
+                "errors": sum(count for (method, endpoint, status), count in self.requests.items()
+                              if not status or status >= 400),
+                "bytes": total_bytes,
+                "throughput": total_bytes / elapsed,
+                "throttled": sum(self.throttled.values()),
+                "throttle_wait": sum(self.throttle_wait.values()),
+                "token_refreshes": self.token_refreshes,
+                "endpoints": endpoints
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        logging.info("{requests} requests ({errors} failed) in {elapsed:.1f} s, {mb:.1f} MB at {rate:.1f} MB/s, "
+                     "{throttled} throttled for {throttle_wait:.1f} s, {token_refreshes} token refreshes".format(
+                         mb=summary["bytes"] / 1e6, rate=summary["throughput"] / 1e6, **summary))
+        for endpoint, stats in sorted(summary["endpoints"].items(), key=lambda item: -item[1]["requests"]):
+            logging.info("{} {requests} requests, p50 {p50:.3f} s, p95 {p95:.3f} s, {mb:.1f} MB, {retries} retries, "
+                         "{throttled} throttled".format(
+                             endpoint, mb=(stats["bytes_sent"] + stats["bytes_received"]) / 1e6, **stats))
+
+    def prometheus(self, prefix="sharepoint"):
+        """ Metrics in the Prometheus text exposition format, e.g. for the node exporter textfile collector """
+        summary = self.summary()
+        with self.lock:
+            requests = dict(self.requests)
+        lines = [
+            "# HELP {}_requests_total Graph requests by endpoint and status".format(prefix),
+            "# TYPE {}_requests_total counter".format(prefix)]
+        for (method, endpoint, status), count in sorted(requests.items(), key=str):
+            lines.append('{}_requests_total{{method="{}",endpoint="{}",status="{}"}} {}'.format(
+                prefix, method, endpoint, status or "error", count))
+        lines += [
+            "# HELP {}_request_duration_seconds Graph request latency by endpoint".format(prefix),
+            "# TYPE {}_request_duration_seconds summary".format(prefix)]
+        for endpoint, stats in sorted(summary["endpoints"].items()):
+            for quantile, key in QUANTILES:
+                lines.append('{}_request_duration_seconds{{endpoint="{}",quantile="{}"}} {:.6f}'.format(
+                    prefix, endpoint, quantile, stats[key]))
+            with self.lock:
+                total = sum(self.latencies[endpoint])
+            lines.append('{}_request_duration_seconds_sum{{endpoint="{}"}} {:.6f}'.format(prefix, endpoint, total))
+            lines.append('{}_request_duration_seconds_count{{endpoint="{}"}} {}'.format(
+                prefix, endpoint, stats["requests"]))
+        for name, key, kind in (("bytes_sent_total", "bytes_sent", "counter"),
+                                ("bytes_received_total", "bytes_received", "counter"),
+                                ("retries_total", "retries", "counter"),
+                                ("throttled_total", "throttled", "counter"),
+                                ("throttle_wait_seconds_total", "throttle_wait", "counter")):
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for endpoint, stats in sorted(summary["endpoints"].items()):
+                lines.append('{}_{}{{endpoint="{}"}} {}'.format(prefix, name, endpoint, stats[key]))
+        lines += ["# TYPE {}_token_refreshes_total counter".format(prefix),
+                  "{}_token_refreshes_total {}".format(prefix, summary["token_refreshes"])]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="sharepoint"):
+        # written aside and renamed, so a scraper never reads a half written file
+        with open(path + ".tmp", 'w') as f:
+            f.write(self.prometheus(prefix))
+        os.replace(path + ".tmp", path)
+        logging.info("Metrics are written to '{}'".format(path))
+
+
+class StatsdExporter:
+    """ Client hook sending every request event to StatsD over UDP: a request counter per endpoint
+    and status, request latency as a timer, and bytes, retries and throttle waits """
+    def __init__(self, address, prefix="sharepoint"):
+        host, _, port = address.partition(":")
+        self.address = (host, int(port or 8125))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def metric_name(self, endpoint):
+        return re.sub(r"[^A-Za-z0-9]+", "_", endpoint).strip("_") or "root"
+
+    def send(self, lines):
+        try:
+            self.socket.sendto("\n".join(lines).encode(), self.address)
+        except OSError as error:
+            logging.debug("StatsD metrics are not sent: {}".format(error))
+
+    def __call__(self, event):
+        if event["type"] == "token_refresh":
+            return self.send(["{}.token_refreshes:1|c".format(self.prefix),
+                              "{}.token_latency:{:.0f}|ms".format(self.prefix, event["latency"] * 1000)])
+        if event["type"] != "request":
+            return
+        name = "{}.{}".format(self.prefix, self.metric_name(event["endpoint"]))
+        lines = ["{}.requests.{}:1|c".format(name, event["status"] or "error"),
+                 "{}.latency:{:.0f}|ms".format(name, event["latency"] * 1000)]
+        if event["bytes_sent"]:
+            lines.append("{}.bytes_sent:{}|c".format(name, event["bytes_sent"]))
+        if event["bytes_received"]:
+            lines.append("{}.bytes_received:{}|c".format(name, event["bytes_received"]))
+        if event["retries"]:
+            lines.append("{}.retries:{}|c".format(name, event["retries"]))
+        if event["throttled"]:
+            lines.append("{}.throttled:{}|c".format(name, event["throttled"]))
+            lines.append("{}.throttle_wait:{:.0f}|ms".format(name, event["throttle_wait"] * 1000))
+        self.send(lines)
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,113 @@
+import json
+import logging
+from collections import Counter
+
+CREATE = "create"
+REPLACE = "replace"
+SKIP = "skip"
+DELETE = "delete"
+DELETE_LOCAL = "delete_local"
+DOWNLOAD = "download"
+CONFLICT = "conflict"
+
+# Conflict policies of two-way sync, for files changed on both sides since the last sync
+REMOTE_WINS = "remote"
+LOCAL_WINS = "local"
+KEEP_BOTH = "keep_both"
+CONFLICT_POLICIES = (REMOTE_WINS, LOCAL_WINS, KEEP_BOTH)
+
+
+def plan_upload(file_names, file_items_info, parent_id, is_current=None, delete_remote=False):
+    """ Match local files against remote file items by name, in O(n + m) through a name index.
+    is_current(file_name, file_item_info) returns why an existing remote file needs no upload,
+    or None. Returns a list of actions: create / replace / skip, and delete for remote files
+    missing locally when delete_remote is set """
+    remote_index = {file_item_info["name"]: file_item_info for file_item_info in file_items_info
+                    if "file" in file_item_info}
+    plan = []
+    for file_name in file_names:
+        file_item_info = remote_index.get(file_name)
+        if file_item_info is None:
+            plan.append({"action": CREATE, "name": file_name, "parentId": parent_id})
+            continue
+        reason = is_current(file_name, file_item_info) if is_current else None
+        if reason:
+            plan.append({"action": SKIP, "name": file_name, "itemId": file_item_info["id"], "reason": reason})
+        else:
+            plan.append({"action": REPLACE, "name": file_name, "itemId": file_item_info["id"]})
+    if delete_remote:
+        local_names = set(file_names)
+        for name, file_item_info in remote_index.items():
+            if name not in local_names:
+                plan.append({"action": DELETE, "name": name, "itemId": file_item_info["id"]})
+    return plan
+
+
+def plan_sync(file_names, file_items_info, parent_id, get_row, is_local_unchanged, is_identical=None):
+    """ Two-way plan: compare both sides with the state recorded at the last sync, in O(n + m).
+    get_row(file_name) returns the manifest row of the last sync or None,
+    is_local_unchanged(row, file_name) whether the local file still matches it, and
+    is_identical(file_name, file_item_info) whether contents match when there is no row.
+    Files changed on one side only are transferred in that direction, files changed on both
+    sides are planned as conflicts to be resolved by the conflict policy. A file synced before and
+    deleted on one side is deleted on the other side too, unless it changed there since """
+    remote_index = {file_item_info["name"]: file_item_info for file_item_info in file_items_info
+                    if "file" in file_item_info}
+    plan = []
+    for file_name in file_names:
+        file_item_info = remote_index.pop(file_name, None)
+        row = get_row(file_name)
+        if file_item_info is None:
+            if row is not None and is_local_unchanged(row, file_name):
+                plan.append({"action": DELETE_LOCAL, "name": file_name})
+                continue
+            if row is not None:
+                logging.warning("'{}' is deleted remotely but changed locally, uploading it again".format(file_name))
+            plan.append({"action": CREATE, "name": file_name, "parentId": parent_id})
+            continue
+        if row is None:
+            if is_identical and is_identical(file_name, file_item_info):
+                plan.append({"action": SKIP, "name": file_name, "itemId": file_item_info["id"],
+                             "eTag": file_item_info.get("eTag"), "reason": "identical on both sides"})
+                continue
+            local_changed = remote_changed = True
+        else:
+            local_changed = not is_local_unchanged(row, file_name)
+            remote_changed = row["etag"] != file_item_info.get("eTag")
+        if local_changed and remote_changed:
+            action = CONFLICT
+        elif local_changed:
+            action = REPLACE
+        elif remote_changed:
+            action = DOWNLOAD
+        else:
+            action = SKIP
+        plan.append({"action": action, "name": file_name, "itemId": file_item_info["id"],
+                     "eTag": file_item_info.get("eTag"), "parentId": parent_id})
+    for name, file_item_info in remote_index.items():
+        row = get_row(name)
+        if row is not None and row["etag"] == file_item_info.get("eTag"):
+            plan.append({"action": DELETE, "name": name, "itemId": file_item_info["id"],
+                         "eTag": file_item_info.get("eTag")})
+            continue
+        if row is not None:
+            logging.warning("'{}' is deleted locally but changed remotely, downloading it again".format(name))
+        plan.append({"action": DOWNLOAD, "name": name, "itemId": file_item_info["id"],
+                     "eTag": file_item_info.get("eTag")})
+    return plan
+
+
+def summarize_plan(plan):
+    counts = Counter(action["action"] for action in plan)
+    return ", ".join("{} {}".format(counts[action], action) for action in
+                     (CREATE, REPLACE, DOWNLOAD, CONFLICT, SKIP, DELETE, DELETE_LOCAL) if counts[action])
+
+
+def dump_plan(plan):
+    return json.dumps(plan, indent=2)
+
+
+def log_plan(plan, name="Upload"):
+    logging.info("{} plan: {}".format(name, summarize_plan(plan) or "nothing to do"))
+    for action in plan:
+        logging.debug("{action}: {name}".format(**action))
@@ -0,0 +1,160 @@
+import time
+import threading
+import logging
+import tqdm
+
+
+class NoProgress:
+    """ Progress sink that reports nothing """
+    def start(self, name, total, initial=0):
+        return NoProgressTask(total)
+
+
+class NoProgressTask:
+    def __init__(self, total):
+        self.total = total
+
+    def update(self, n):
+        pass
+
+    def close(self):
+        pass
+
+
+class TqdmProgress:
+    """ Progress bar per transfer, for interactive use """
+    def start(self, name, total, initial=0):
+        return tqdm.tqdm(total=total, initial=initial, unit='B', unit_scale=True, desc=name, leave=True)
+
+
+class LogProgress:
+    """ Logs progress of each transfer at most once per interval seconds, so scheduler logs stay readable """
+    def __init__(self, interval=30):
+        self.interval = interval
+
+    def start(self, name, total, initial=0):
+        return LogProgressTask(name, total, initial, self.interval)
+
+
+class LogProgressTask:
+    def __init__(self, name, total, initial, interval):
+        self.name = name
+        self.total = total
+        self.done = initial
+        self.interval = interval
+        self.lastReport = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if now - self.lastReport < self.interval:
+                return
+            self.lastReport = now
+        if self.total:
+            logging.info("'{}' {:.0%} ({} of {} bytes)".format(self.name, self.done / self.total, self.done, self.total))
+        else:
+            logging.info("'{}' {} bytes".format(self.name, self.done))
+
+    def close(self):
+        pass
+
+
+class CallbackProgress:
+    """ Calls callback(name, done, total) after every update """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def start(self, name, total, initial=0):
+        return CallbackProgressTask(self.callback, name, total, initial)
+
+
+class CallbackProgressTask:
+    def __init__(self, callback, name, total, initial):
+        self.callback = callback
+        self.name = name
+        self.total = total
+        self.done = initial
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.done += n
+            done = self.done
+        self.callback(self.name, done, self.total)
+
+    def close(self):
+        pass
+
+
+class SharedProgressTask:
+    """ Task of another sink updated from several threads, e.g. the aggregate progress of a pool
+    of downloads. share(size) returns the sink of one file of the pool """
+    def __init__(self, task):
+        self.task = task
+        self.lock = threading.Lock()
+
+    @property
+    def total(self):
+        return self.task.total
+
+    @total.setter
+    def total(self, total):
+        with self.lock:
+            self.task.total = total
+
+    def update(self, n):
+        with self.lock:
+            self.task.update(n)
+
+    def close(self):
+        self.task.close()
+
+    def share(self, size):
+        return SharedProgress(self, size)
+
+
+class SharedProgress:
+    """ Progress sink adding the bytes of one file to a SharedProgressTask as they arrive. Bytes
+    resumed from an earlier attempt count as done, and the file never adds more than its size,
+    even when it is downloaded again from the start """
+    def __init__(self, task, size):
+        self.task = task
+        self.size = size
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def start(self, name, total, initial=0):
+        self.update(initial - self.done)
+        return self
+
+    def update(self, n):
+        with self.lock:
+            n = max(0, min(n, self.size - self.done))
+            self.done += n
+        if n:
+            self.task.update(n)
+
+    def close(self):
+        pass
+
+
+PROGRESS_SINKS = {
+    "tqdm": TqdmProgress,
+    "log": LogProgress,
+    "none": NoProgress
+}
+
+
+def get_progress(progress):
+    """ Progress sink from its name in PROGRESS_SINKS, a callback, or an object with a start method """
+    if progress is None:
+        return TqdmProgress()
+    if isinstance(progress, str):
+        if progress not in PROGRESS_SINKS:
+            raise Exception("Unknown progress '{}', expected one of {}".format(progress, list(PROGRESS_SINKS)))
+        return PROGRESS_SINKS[progress]()
+    if hasattr(progress, "start"):
+        return progress
+    return CallbackProgress(progress)
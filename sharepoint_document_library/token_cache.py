@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks on Windows, the cache still works for one process at a time
+    fcntl = None
+
+
+def get_cache_key(tenant_name, client_id, scope):
+    """ Tokens are cached per tenant, client and scope, the ids are hashed rather than stored """
+    return hashlib.sha256("{}|{}|{}".format(tenant_name, client_id, scope).encode()).hexdigest()
+
+
+class TokenCache:
+    """ Access tokens shared between processes through a JSON file readable by its owner only (0600).
+    lock() holds an exclusive file lock, so only one process requests a new token while the others
+    wait and then reuse it. With key, the file is encrypted with Fernet, which needs the
+    cryptography package (`pip install .[encryption]`) """
+    def __init__(self, path, key=None):
+        self.path = path
+        self.fernet = None
+        if key:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError:
+                raise Exception("Coundn't encrypt token cache, the cryptography package is not installed")
+            # any passphrase is accepted, Fernet needs 32 url-safe base64 encoded bytes
+            self.fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(key.encode()).digest()))
+
+    @contextmanager
+    def lock(self):
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if self.fernet is not None:
+                data = self.fernet.decrypt(data)
+            return json.loads(data.decode())
+        except Exception as error:
+            # unreadable, written with another key or corrupted: a new token is requested instead
+            logging.warning("Token cache '{}' is not readable, ignoring it: {!r}".format(self.path, error))
+            return {}
+
+    def save(self, entries):
+        data = json.dumps(entries).encode()
+        if self.fernet is not None:
+            data = self.fernet.encrypt(data)
+        tmp_file = self.path + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # O_CREAT leaves the mode of a leftover temporary file as it was
+        os.chmod(tmp_file, 0o600)
+        os.replace(tmp_file, self.path)
+
+    def get(self, cacheKey, margin=0):
+        """ (access token, expiry time) still valid for margin seconds, or None """
+        entry = self.load().get(cacheKey)
+        if entry is None or entry["expiresAt"] - margin <= time.time():
+            return None
+        return entry["accessToken"], entry["expiresAt"]
+
+    def set(self, cacheKey, accessToken, expiresAt):
+        entries = {key: entry for key, entry in self.load().items() if entry["expiresAt"] > time.time()}
+        entries[cacheKey] = {"accessToken": accessToken, "expiresAt": expiresAt}
+        self.save(entries)
+
+    def discard(self, cacheKey, accessToken=None):
+        """ Forget the cached token, e.g. after it was rejected with 401, unless it was already replaced """
+        with self.lock():
+            entries = self.load()
+            entry = entries.get(cacheKey)
+            if entry is not None and (accessToken is None or entry["accessToken"] == accessToken):
+                del entries[cacheKey]
+                self.save(entries)
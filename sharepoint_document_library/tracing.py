@@ -0,0 +1,155 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import itertools
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+class NoTracer:
+    """ Tracer used when tracing is off, spans cost nothing """
+    def span(self, name, category, **args):
+        return nullcontext()
+
+    def bind(self, function):
+        return function
+
+    def save(self):
+        pass
+
+
+class Tracer:
+    """ Records the timeline of a run as nested spans: run -> phase -> transfer -> request / chunk,
+    saved as Chrome trace-event JSON (chrome://tracing, Perfetto). Every thread keeps its own stack of
+    open spans; work handed to a thread pool is wrapped with bind(), so its spans are attached to the
+    span that submitted it. Request and chunk spans come from client request events,
+    so the tracer is also a client hook. With profile, the thread that created the tracer runs
+    under cProfile; with trace_memory, tracemalloc usage is sampled at the end of every phase """
+    def __init__(self, path, profile=False, trace_memory=False):
+        self.path = path
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.threads = set()
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.metadata = {"startTime": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        """ Id of the innermost span open on this thread """
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    def bind(self, function):
+        """ function running with the span open on the calling thread as the parent of its spans,
+        for work submitted to a thread pool """
+        parentId = self.current()
+
+        def bound(*args, **kwargs):
+            stack = self.stack()
+            stack.append(parentId)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.pop()
+        return bound
+
+    def add(self, event):
+        thread = threading.current_thread()
+        event.setdefault("pid", self.pid)
+        event.setdefault("tid", thread.ident)
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident,
+                                    "args": {"name": thread.name}})
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        stack = self.stack()
+        spanId = next(self.ids)
+        parentId = stack[-1] if stack else None
+        stack.append(spanId)
+        start = self.now()
+        try:
+            yield
+        finally:
+            end = self.now()
+            stack.pop()
+            self.add({"name": name, "cat": category, "ph": "X", "ts": start, "dur": end - start,
+                      "args": dict(args, id=spanId, parent=parentId)})
+            if self.trace_memory and category in ("run", "phase"):
+                self.sample_memory()
+
+    def sample_memory(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.add({"name": "memory", "ph": "C", "ts": self.now(), "args": {"current": current, "peak": peak}})
+
+    def __call__(self, event):
+        """ Client hook: a request span ending now, a chunk span for ranged downloads and upload fragments """
+        end = self.now()
+        if event["type"] == "token_refresh":
+            name, category, args = "token", "request", {"status": event["status"]}
+        elif event["type"] == "request":
+            name = "{} {}".format(event["method"], event["endpoint"])
+            category = "chunk" if event.get("range") else "request"
+            args = {key: event[key] for key in ("status", "bytes_sent", "bytes_received", "retries", "throttle_wait")}
+            if event.get("range"):
+                args["range"] = event["range"]
+        else:
+            return
+        args["id"] = next(self.ids)
+        args["parent"] = self.current()
+        duration = event["latency"] * 1e6
+        self.add({"name": name, "cat": category, "ph": "X", "ts": end - duration, "dur": duration, "args": args})
+
+    def save(self):
+        # snapshot first, so the allocations of the profile dump are not in it
+        if self.trace_memory and tracemalloc.is_tracing():
+            self.sample_memory()
+            snapshot = tracemalloc.take_snapshot()
+            self.metadata["tracemalloc"] = [str(statistic) for statistic in snapshot.statistics("lineno")[:25]]
+        if self.profiler is not None:
+            self.profiler.disable()
+            profile_path = self.path + ".prof"
+            self.profiler.dump_stats(profile_path)
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(25)
+            self.metadata["profile"] = {"path": profile_path, "top": output.getvalue().splitlines()}
+            self.profiler = None
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms", "metadata": self.metadata}
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(trace, f)
+        os.replace(self.path + ".tmp", self.path)
+        logging.info("Trace with {} events is written to '{}'".format(len(trace["traceEvents"]), self.path))
+
+
+def get_tracer(config):
+    """ Tracer when trace_path is set in config, NoTracer otherwise """
+    if not config.get('trace_path'):
+        return NoTracer()
+    return Tracer(config['trace_path'], profile=bool(config.get('trace_profile', False)),
+                  trace_memory=bool(config.get('trace_memory', False)))
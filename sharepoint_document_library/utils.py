@@ -1,24 +1,55 @@
 import io
 import os
+import mmap
 import json
+from contextlib import contextmanager
 from datetime import datetime
 import argparse
 from os import listdir
 from os.path import isfile, join
 
-def open_file(file_path):
+@contextmanager
+def map_file(file_path):
+    """ Memory-map file read-only and yield a memoryview over it, so fragments can be
+    sliced and sent without copying the file into process memory """
     with open(file_path, 'rb') as f:
-        data = f.read()
-    return data
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+# partial downloads, never uploaded
+PARTIAL_DOWNLOAD_SUFFIXES = ('.part', '.part.json')
 
 def get_file_names(upload_path):
-    file_names = [f for f in listdir(upload_path) if isfile(join(upload_path, f))]
+    file_names = [f for f in listdir(upload_path)
+                  if isfile(join(upload_path, f)) and not f.endswith(PARTIAL_DOWNLOAD_SUFFIXES)]
     return file_names
 
 def load_json(path):
     with open(path) as fil:
         return json.load(fil)
 
+def get_state_file(config, file_name):
+    """ Path of a file persisted between runs, kept outside of download/upload directories """
+    state_path = os.path.expanduser(config.get('state_path', '~/.sharepoint_document_library'))
+    os.makedirs(state_path, exist_ok=True)
+    return join(state_path, file_name)
+
+def load_state(state_file, default):
+    if not os.path.exists(state_file):
+        return default
+    return load_json(state_file)
+
+def save_state(state_file, state):
+    # write to a temporary file first, so an interrupted run never leaves a truncated state file
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as fil:
+        json.dump(state, fil)
+    os.replace(tmp_file, state_file)
+
 # def saveAsJson(data, filePath):
 #     abs_path = get_abs_path(filePath)
 #     with open(abs_path, 'w') as file:
@@ -43,6 +74,99 @@ def parse_args(required_config_keys):
         '-u', '--upload_path',
         help='Local path to upload files to Sharepoint')
 
+    parser.add_argument(
+        '-w', '--max_workers',
+        type=int,
+        help='Number of files transferred in parallel (overrides max_workers in config)')
+
+    parser.add_argument(
+        '-r', '--recursive',
+        action='store_true',
+        help='Download files from all folders of the document library, mirroring the folder tree locally')
+
+    parser.add_argument(
+        '-i', '--incremental',
+        action='store_true',
+        help='Download only files added or modified since the previous run')
+
+    parser.add_argument(
+        '--delete_removed',
+        action='store_true',
+        help='With --incremental, delete local files that were removed from Sharepoint')
+
+    parser.add_argument(
+        '-m', '--manifest',
+        action='store_true',
+        help='Keep a local manifest of transferred files and skip files unchanged since the last transfer')
+
+    parser.add_argument(
+        '-s', '--sync_path',
+        help='Directory synced both ways with the document library')
+
+    parser.add_argument(
+        '--conflict_policy',
+        choices=['remote', 'local', 'keep_both'],
+        help='With --sync_path, which version wins when a file changed on both sides')
+
+    parser.add_argument(
+        '-n', '--dry_run',
+        action='store_true',
+        help='Print the upload or sync plan as JSON without transferring anything')
+
+    parser.add_argument(
+        '--delete_remote',
+        action='store_true',
+        help='When uploading, delete files of the document library that do not exist locally')
+
+    parser.add_argument(
+        '-p', '--progress',
+        choices=['tqdm', 'log', 'none'],
+        help='How transfer progress is reported: progress bars, periodic log lines or not at all')
+
+    parser.add_argument(
+        '--verify_hashes',
+        action='store_true',
+        help='Check downloads against the hashes of the drive item and skip uploads identical to the remote file')
+
+    parser.add_argument(
+        '--token_cache',
+        action='store_true',
+        help='Reuse access tokens between runs through a token cache file in state_path')
+
+    parser.add_argument(
+        '--metrics_path',
+        help='Write request metrics of the run to this file in Prometheus text format')
+
+    parser.add_argument(
+        '--trace_path',
+        help='Write a trace of the run to this file as Chrome trace-event JSON')
+
+    parser.add_argument(
+        '--trace_profile',
+        action='store_true',
+        help='With --trace_path, also profile the main thread with cProfile')
+
+    parser.add_argument(
+        '--trace_memory',
+        action='store_true',
+        help='With --trace_path, also record memory use with tracemalloc')
+
+    parser.add_argument(
+        '-l', '--list_name',
+        help='Sharepoint list to export')
+
+    parser.add_argument(
+        '-e', '--export_path',
+        help='File the list items are written to, as CSV when it ends with .csv and NDJSON otherwise')
+
+    parser.add_argument(
+        '--fields',
+        help='Comma separated list columns to export')
+
+    parser.add_argument(
+        '--filter',
+        help="OData filter on the list items, e.g. \"fields/Status eq 'Open'\"")
+
     args = parser.parse_args()
     if args.config:
         setattr(args, 'config_path', args.config)
@@ -54,6 +178,8 @@ def parse_args(required_config_keys):
     if args.upload_path:
         setattr(args, 'upload_path', args.upload_path)
         args.upload_path = get_abs_path(args.upload_path)
+    if args.sync_path:
+        args.sync_path = get_abs_path(args.sync_path)
 
     check_config(args.config, required_config_keys)
 